@@ -0,0 +1,101 @@
+###############################################################################
+##
+##  hardcode_haml - Haml for hardcore coders
+##  Copyright (C) 2010  Thammi
+## 
+##  This program is free software: you can redistribute it and/or modify
+##  it under the terms of the GNU Affero General Public License as published by
+##  the Free Software Foundation, either version 3 of the License, or
+##  (at your option) any later version.
+## 
+##  This program is distributed in the hope that it will be useful,
+##  but WITHOUT ANY WARRANTY; without even the implied warranty of
+##  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##  GNU Affero General Public License for more details.
+## 
+##  You should have received a copy of the GNU Affero General Public License
+##  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+###############################################################################
+
+'''Generators for synthetic Haml corpora used by the benchmarks. Each corpus
+is a list of (name, source) tuples, scale controls the size'''
+
+def deep_nesting(scale):
+    '''Deeply nested tags and blocks'''
+    depth = 40
+    lines = ["? int n"]
+
+    for _ in range(scale):
+        for level in range(depth):
+            if level % 4 == 3:
+                lines.append("  " * level + "- if(n > %i)" % level)
+            else:
+                lines.append("  " * level + "%%div.level%i" % level)
+
+        lines.append("  " * depth + "%span deepest #{n}")
+
+    return [("deep_nesting", "\n".join(lines) + "\n")]
+
+def wide_attributes(scale):
+    '''Tags with long attribute hashes and lists'''
+    width = 50
+    lines = ["? const char *value, int flag"]
+
+    hash_attrs = ', '.join('"data-h%i" => "v%i"' % (i, i) for i in range(width))
+    list_attrs = ' '.join('data-l%i="%i"' % (i, i) for i in range(width))
+
+    for _ in range(scale * 10):
+        lines.append('%%div{%s, "title" => value}' % hash_attrs)
+        lines.append('%%input(%s checked?=flag)' % list_attrs)
+
+    return [("wide_attributes", "\n".join(lines) + "\n")]
+
+def long_multilines(scale):
+    '''Text split into long '|' multilines'''
+    lines = ["%div"]
+
+    for block in range(scale * 10):
+        lines.append("  %p")
+
+        for part in range(30):
+            lines.append("    some text of part %i in block %i |" % (part, block))
+
+        lines.append("  %hr")
+
+    return [("long_multilines", "\n".join(lines) + "\n")]
+
+def interpolation(scale):
+    '''Text with many #{} interpolations'''
+    lines = ["? const char *a, const char *b", "%div"]
+
+    text = ' '.join("x #{a} y #{b} #{\"c\"}" for _ in range(10))
+
+    for _ in range(scale * 50):
+        lines.append("  %p " + text)
+        lines.append("  " + text)
+
+    return [("interpolation", "\n".join(lines) + "\n")]
+
+def small_files(scale):
+    '''Many small templates'''
+    source = '''\
+? const char *title
+!!! 5
+%html
+  %head
+    %title = title
+  %body
+    #content.main
+      %p Hello #{title}
+'''
+
+    return [("small_%i" % index, source) for index in range(scale * 20)]
+
+corpora = {
+        'deep_nesting': deep_nesting,
+        'wide_attributes': wide_attributes,
+        'long_multilines': long_multilines,
+        'interpolation': interpolation,
+        'small_files': small_files,
+        }
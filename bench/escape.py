@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+###############################################################################
+##
+##  hardcode_haml - Haml for hardcore coders
+##  Copyright (C) 2010  Thammi
+## 
+##  This program is free software: you can redistribute it and/or modify
+##  it under the terms of the GNU Affero General Public License as published by
+##  the Free Software Foundation, either version 3 of the License, or
+##  (at your option) any later version.
+## 
+##  This program is distributed in the hope that it will be useful,
+##  but WITHOUT ANY WARRANTY; without even the implied warranty of
+##  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##  GNU Affero General Public License for more details.
+## 
+##  You should have received a copy of the GNU Affero General Public License
+##  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+###############################################################################
+
+'''Measures the throughput of the runtime HTML escaping helpers on escape
+heavy and on clean text. The C helper is only measured if a C compiler is
+available'''
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from hardcode_haml.lang.c import escape_header
+from hardcode_haml.lang.python import escape_helper
+from hardcode_haml.primitives import html_escape_table
+
+inputs = [
+        ("heavy", '<a href="/item?id=1&amp;x=2">Tom & Jerry\'s</a>' * 100),
+        ("mixed", 'Some text with an occasional <b>tag</b> in it. ' * 100),
+        ("clean", 'Plain text without any special characters at all. ' * 100),
+        ]
+
+c_bench = r'''
+#include <stdio.h>
+#include <stdlib.h>
+#include <time.h>
+#include "hamlescape.h"
+
+/* the straightforward way: one check and one write per character */
+static size_t naive_escape(char *buf, size_t cap, size_t pos, const char *str) {
+	for(; *str; str++) {
+		const char *entity = NULL;
+
+		switch(*str) {
+			case '&': entity = "&amp;"; break;
+			case '<': entity = "&lt;"; break;
+			case '>': entity = "&gt;"; break;
+			case '"': entity = "&quot;"; break;
+			case '\'': entity = "&#39;"; break;
+		}
+
+		if(entity) {
+			struct haml_buf state = { buf, cap, pos };
+			haml_buf_sink(&state, entity, strlen(entity));
+			pos = state.pos;
+		} else {
+			if(pos < cap) {
+				buf[pos] = *str;
+			}
+
+			pos++;
+		}
+	}
+
+	return pos;
+}
+
+static double measure(int naive, const char *str, int rounds) {
+	static char buf[1 << 16];
+	size_t total = 0;
+	clock_t start = clock();
+	int i;
+
+	for(i = 0; i < rounds; i++) {
+		if(naive) {
+			total += naive_escape(buf, sizeof(buf), 0, str);
+		} else {
+			total += haml_escape_buf(buf, sizeof(buf), 0, str);
+		}
+	}
+
+	return total / ((double) (clock() - start) / CLOCKS_PER_SEC) / 1e6;
+}
+
+int main(int argc, char *argv[]) {
+	int rounds = atoi(argv[1]);
+	int i;
+
+	for(i = 2; i < argc; i++) {
+		printf("%f %f\n", measure(0, argv[i], rounds),
+				measure(1, argv[i], rounds));
+	}
+
+	return 0;
+}
+'''
+
+def python_helpers():
+    namespace = {}
+    exec(escape_helper, namespace)
+
+    return [
+            ("replace", namespace['_escape']),
+            ("translate", lambda value: str(value).translate(html_escape_table)),
+            ]
+
+def throughput(fun, text, rounds):
+    '''Returns the best output throughput of fun(text) in MB/s'''
+    best = None
+    size = len(fun(text).encode('utf-8'))
+
+    for _ in range(5):
+        start = time.perf_counter()
+
+        for _ in range(rounds):
+            fun(text)
+
+        elapsed = time.perf_counter() - start
+
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return size * rounds / best / 1e6
+
+def c_throughput(rounds):
+    '''Returns (helper, naive) throughputs for each input or None without a
+    C compiler'''
+    compiler = shutil.which('cc') or shutil.which('gcc')
+
+    if not compiler:
+        return None
+
+    directory = tempfile.mkdtemp(prefix="hardcode_haml_bench")
+
+    try:
+        with open(os.path.join(directory, "hamlescape.h"), 'w') as out:
+            out.write(escape_header)
+
+        source = os.path.join(directory, "bench.c")
+        binary = os.path.join(directory, "bench")
+
+        with open(source, 'w') as out:
+            out.write(c_bench)
+
+        subprocess.check_call([compiler, '-O2', '-o', binary, source])
+
+        result = subprocess.check_output([binary, str(rounds)] +
+                [text for _, text in inputs])
+    finally:
+        shutil.rmtree(directory)
+
+    return [tuple(float(value) for value in line.split())
+            for line in result.decode().splitlines()]
+
+def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+
+    for name, fun in python_helpers():
+        for text_name, text in inputs:
+            print("python %-10s %-6s %8.1f MB/s" % (name, text_name,
+                throughput(fun, text, rounds)))
+
+    results = c_throughput(rounds * 10)
+
+    if results == None:
+        print("no C compiler found")
+        return
+
+    for (text_name, _), (helper, naive) in zip(inputs, results):
+        print("c      %-10s %-6s %8.1f MB/s" % ("table", text_name, helper))
+        print("c      %-10s %-6s %8.1f MB/s" % ("naive", text_name, naive))
+
+if __name__ == '__main__':
+    main()
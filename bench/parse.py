@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+###############################################################################
+##
+##  hardcode_haml - Haml for hardcore coders
+##  Copyright (C) 2010  Thammi
+## 
+##  This program is free software: you can redistribute it and/or modify
+##  it under the terms of the GNU Affero General Public License as published by
+##  the Free Software Foundation, either version 3 of the License, or
+##  (at your option) any later version.
+## 
+##  This program is distributed in the hope that it will be useful,
+##  but WITHOUT ANY WARRANTY; without even the implied warranty of
+##  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##  GNU Affero General Public License for more details.
+## 
+##  You should have received a copy of the GNU Affero General Public License
+##  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+###############################################################################
+
+'''Measures how many lines per second HamlFile.parse() processes on a large
+synthetic template'''
+
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from hardcode_haml.parser import HamlFile
+
+block = '''\
+%div#item.entry(data-id="1" checked?=active)
+  %h2.title = title
+  %p Some static text with #{value} inside
+  - if(flag)
+    %span{"class" => "flag", "title" => "yes"} set
+  / a comment
+  \\= escaped
+  long multiline text |
+    continued here |
+  %br
+'''
+
+def synthetic(blocks):
+    return "? const char *title, int value, int flag, int active\n" + block * blocks
+
+def main():
+    blocks = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+    source = synthetic(blocks)
+    lines = source.count('\n')
+
+    best = None
+
+    for _ in range(rounds):
+        inp = io.StringIO(source)
+
+        start = time.perf_counter()
+        HamlFile(inp, {'auto_indent': True})
+        elapsed = time.perf_counter() - start
+
+        if best is None or elapsed < best:
+            best = elapsed
+
+    print("%i lines in %.3fs: %.0f lines/s" % (lines, best, lines / best))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+###############################################################################
+##
+##  hardcode_haml - Haml for hardcore coders
+##  Copyright (C) 2010  Thammi
+## 
+##  This program is free software: you can redistribute it and/or modify
+##  it under the terms of the GNU Affero General Public License as published by
+##  the Free Software Foundation, either version 3 of the License, or
+##  (at your option) any later version.
+## 
+##  This program is distributed in the hope that it will be useful,
+##  but WITHOUT ANY WARRANTY; without even the implied warranty of
+##  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##  GNU Affero General Public License for more details.
+## 
+##  You should have received a copy of the GNU Affero General Public License
+##  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+###############################################################################
+
+'''Measures the time per render of the code generated by the Python output
+modules on a realistic page'''
+
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from hardcode_haml.engine import compile_template
+from hardcode_haml.lang.python import PythonWriter, PythonStrWriter
+
+page = '''\
+? title, user, nav, items
+!!! 5
+%html
+  %head
+    %title = title
+    %meta{"charset" => "utf-8"}
+    %link{"rel" => "stylesheet", "href" => "/static/style.css"}
+  %body
+    #header
+      %h1.title = title
+      %p.user Logged in as #{user}
+    %ul#nav
+      - for href, label in nav
+        %li
+          %a{"href" => href} = label
+    #content
+      %table.items
+        %tr
+          %th Name
+          %th Count
+          %th Price
+        - for name, count, price in items
+          %tr
+            %td.name = name
+            %td.count = count
+            %td.price #{price} EUR
+    #footer
+      %p Rendered by Hardcode Haml
+'''
+
+class LegacyWriter(PythonWriter):
+    '''The code generated before the Python module was optimized, kept for
+    comparison'''
+
+    PROLOGUE = []
+
+    def evaluate(self, cmd, escape=False):
+        self.execute("out.write(str({cmd}))".format(cmd=cmd))
+
+    def flush(self):
+        if self.write_buf:
+            data = ''.join(self.write_buf)
+            self.write_buf = []
+            self.execute('out.write({data})'.format(data=repr(data)))
+
+def stream_render(template):
+    def render(*args):
+        out = io.StringIO()
+        template(out, *args)
+        return out.getvalue()
+
+    return render
+
+def main():
+    renders = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+    args = (
+            "Inventory",
+            "admin",
+            [("/", "Home"), ("/items", "Items"), ("/about", "About")],
+            [("item %i" % i, i, i * 1.5) for i in range(50)],
+            )
+
+    variants = [
+            ("legacy", stream_render(compile_template(page, 'page',
+                writer=LegacyWriter))),
+            ("python", stream_render(compile_template(page, 'page'))),
+            ("python-str", compile_template(page, 'page',
+                writer=PythonStrWriter)),
+            ]
+
+    expected = variants[0][1](*args)
+    legacy = None
+
+    for name, render in variants:
+        if render(*args) != expected:
+            print("%s: output differs" % name)
+            continue
+
+        best = None
+
+        for _ in range(rounds):
+            start = time.perf_counter()
+
+            for _ in range(renders):
+                render(*args)
+
+            elapsed = time.perf_counter() - start
+
+            if best is None or elapsed < best:
+                best = elapsed
+
+        per_render = best / renders * 1e6
+        legacy = legacy or per_render
+
+        print("%-12s %8.1f us/render  %5.2fx" % (name, per_render,
+            legacy / per_render))
+
+if __name__ == '__main__':
+    main()
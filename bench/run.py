@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+###############################################################################
+##
+##  hardcode_haml - Haml for hardcore coders
+##  Copyright (C) 2010  Thammi
+## 
+##  This program is free software: you can redistribute it and/or modify
+##  it under the terms of the GNU Affero General Public License as published by
+##  the Free Software Foundation, either version 3 of the License, or
+##  (at your option) any later version.
+## 
+##  This program is distributed in the hope that it will be useful,
+##  but WITHOUT ANY WARRANTY; without even the implied warranty of
+##  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##  GNU Affero General Public License for more details.
+## 
+##  You should have received a copy of the GNU Affero General Public License
+##  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+###############################################################################
+
+'''Benchmark suite measuring the throughput of the compiler phases on
+synthetic corpora. Results are written as JSON to track regressions:
+
+    bench/run.py -o results.json
+    bench/run.py --scale 5 deep_nesting small_files
+'''
+
+import io
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from hardcode_haml import __version__
+from hardcode_haml.lang import c, cpp, python
+from hardcode_haml.parser import HamlFile, split_lines
+
+from corpus import corpora
+
+writers = [
+        c.CWriter,
+        cpp.FunCppWriter,
+        cpp.ClassCppWriter,
+        python.PythonWriter,
+        ]
+
+opts = {
+        'indent': True,
+        'debug': False,
+        'auto_indent': True,
+        }
+
+def best_of(rounds, fun):
+    '''Returns the fastest wall time of fun() in seconds'''
+    best = None
+
+    for _ in range(rounds):
+        start = time.perf_counter()
+        fun()
+        elapsed = time.perf_counter() - start
+
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return best
+
+def peak_memory(fun):
+    '''Returns the peak of memory allocated by Python while running fun()'''
+    tracemalloc.start()
+
+    try:
+        fun()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def phase(seconds, lines):
+    return {
+            'seconds': seconds,
+            'lines_per_second': lines / seconds if seconds else None,
+            }
+
+def bench_corpus(name, files, rounds, directory):
+    lines = sum(source.count('\n') for _, source in files)
+
+    result = {
+            'corpus': name,
+            'files': len(files),
+            'lines': lines,
+            'bytes': sum(len(source) for _, source in files),
+            }
+
+    def split_all():
+        for _, source in files:
+            for _ in split_lines(io.StringIO(source)):
+                pass
+
+    def parse_all():
+        return [HamlFile(io.StringIO(source), opts) for _, source in files]
+
+    result['split_lines'] = phase(best_of(rounds, split_all), lines)
+    result['parse'] = phase(best_of(rounds, parse_all), lines)
+
+    parsed = list(zip([name for name, _ in files], parse_all()))
+
+    result['execute'] = {}
+    result['peak_memory'] = {}
+
+    for writer in writers:
+        def execute_all():
+            for template, parser in parsed:
+                parser.execute(writer(template, directory))
+
+        def compile_all():
+            for template, source in files:
+                parser = HamlFile(io.StringIO(source), opts)
+                parser.execute(writer(template, directory))
+
+        writer_id = writer.IDS[0]
+
+        try:
+            result['execute'][writer_id] = phase(best_of(rounds, execute_all),
+                    lines)
+            result['peak_memory'][writer_id] = peak_memory(compile_all)
+        except Exception as e:
+            result['execute'][writer_id] = {'error': repr(e)}
+
+    return result
+
+def main():
+    optp = OptionParser(usage="usage: %prog [options] [corpus ...]")
+
+    optp.add_option("-o", "--output",
+            help="Write the JSON results to FILE instead of stdout",
+            metavar="FILE")
+
+    optp.add_option("-s", "--scale",
+            help="Size of the generated corpora",
+            type="int",
+            default=20)
+
+    optp.add_option("-r", "--rounds",
+            help="Repeat each measurement N times and keep the best",
+            metavar="N",
+            type="int",
+            default=3)
+
+    (options, args) = optp.parse_args()
+
+    names = args or sorted(corpora)
+
+    for name in names:
+        if name not in corpora:
+            optp.error("Unknown corpus '%s'" % name)
+
+    directory = tempfile.mkdtemp(prefix="hardcode_haml_bench")
+
+    try:
+        results = [bench_corpus(name, corpora[name](options.scale),
+            options.rounds, directory) for name in names]
+    finally:
+        shutil.rmtree(directory)
+
+    report = {
+            'version': __version__,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'time': time.strftime("%Y-%m-%dT%H:%M:%S"),
+            'scale': options.scale,
+            'rounds': options.rounds,
+            'results': results,
+            }
+
+    out = json.dumps(report, indent=2, sort_keys=True)
+
+    if options.output:
+        with open(options.output, 'w') as out_file:
+            out_file.write(out + "\n")
+    else:
+        print(out)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+###############################################################################
+##
+##  hardcode_haml - Haml for hardcore coders
+##  Copyright (C) 2010  Thammi
+## 
+##  This program is free software: you can redistribute it and/or modify
+##  it under the terms of the GNU Affero General Public License as published by
+##  the Free Software Foundation, either version 3 of the License, or
+##  (at your option) any later version.
+## 
+##  This program is distributed in the hope that it will be useful,
+##  but WITHOUT ANY WARRANTY; without even the implied warranty of
+##  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##  GNU Affero General Public License for more details.
+## 
+##  You should have received a copy of the GNU Affero General Public License
+##  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+###############################################################################
+
+'''Measures the startup of a worker using many Python templates: importing
+all template modules eagerly compared to the lazy package built with
+--package, which imports only the templates used and finds their bytecode
+precompiled
+
+    bench/startup.py [TEMPLATES] [USED] [ROUNDS]
+'''
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from hardcode_haml.lang.python import PythonWriter
+from hardcode_haml.main import compile_files
+from hardcode_haml.package import write_package
+
+from render import page
+
+opts = {
+        'indent': True,
+        'debug': False,
+        'auto_indent': True,
+        }
+
+def best_of(rounds, args, cwd):
+    '''Returns the fastest wall time of running the Python interpreter with
+    args in seconds'''
+    best = None
+
+    # the warm variant has to be able to write bytecode
+    env = dict(os.environ)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+
+    for _ in range(rounds):
+        start = time.perf_counter()
+        subprocess.check_call([sys.executable] + args, cwd=cwd, env=env)
+        elapsed = time.perf_counter() - start
+
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return best
+
+def build(directory, names, package):
+    '''Compile one template for each name into directory/tpl'''
+    sources = os.path.join(directory, "src")
+    target = os.path.join(directory, "tpl")
+    os.makedirs(sources, exist_ok=True)
+    os.makedirs(target)
+
+    in_files = []
+
+    for name in names:
+        in_file = os.path.join(sources, name + ".haml")
+
+        with open(in_file, 'w') as out:
+            out.write(page)
+
+        in_files.append(in_file)
+
+    errors = compile_files(in_files, PythonWriter, target, opts)
+
+    if errors:
+        raise RuntimeError(errors[0])
+
+    if package:
+        write_package(target, names)
+
+def main():
+    templates = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    used = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    rounds = int(sys.argv[3]) if len(sys.argv) > 3 else 5
+
+    names = ["page%i" % index for index in range(templates)]
+
+    directory = tempfile.mkdtemp()
+
+    try:
+        eager = os.path.join(directory, "eager")
+        lazy = os.path.join(directory, "lazy")
+
+        build(eager, names, False)
+        build(lazy, names, True)
+
+        # the templates are plain modules in sys.path
+        imports = "import " + ", ".join(names)
+        lookups = "; ".join("tpl.get(%r)" % name for name in names[:used])
+
+        tpl_eager = os.path.join(eager, "tpl")
+
+        variants = [
+                ("interpreter", ["-c", "pass"], eager),
+                ("eager cold", ["-B", "-c", imports], tpl_eager),
+                ("eager warm", ["-c", imports], tpl_eager),
+                ("lazy", ["-c", "import tpl; " + lookups], lazy),
+                ]
+
+        base = None
+
+        print("%i templates, %i used by the lazy worker" % (templates, used))
+
+        for name, args, cwd in variants:
+            seconds = best_of(rounds, args, cwd)
+
+            if base is None:
+                base = seconds
+                print("%-12s %8.1f ms" % (name, seconds * 1e3))
+            else:
+                print("%-12s %8.1f ms  (%+.1f ms over the interpreter)"
+                        % (name, seconds * 1e3, (seconds - base) * 1e3))
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+###############################################################################
+##
+##  hardcode_haml - Haml for hardcore coders
+##  Copyright (C) 2010  Thammi
+## 
+##  This program is free software: you can redistribute it and/or modify
+##  it under the terms of the GNU Affero General Public License as published by
+##  the Free Software Foundation, either version 3 of the License, or
+##  (at your option) any later version.
+## 
+##  This program is distributed in the hope that it will be useful,
+##  but WITHOUT ANY WARRANTY; without even the implied warranty of
+##  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##  GNU Affero General Public License for more details.
+## 
+##  You should have received a copy of the GNU Affero General Public License
+##  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+###############################################################################
+
+'''Checks that streaming keeps memory usage bounded: the peak while
+compiling a table inside of a code block or a table of static text must not
+grow with the number of rows
+
+    bench/stream.py [ROWS]
+'''
+
+import os
+import shutil
+import sys
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from hardcode_haml.lang import c, cpp, python
+from hardcode_haml.parser import StreamingHamlFile
+
+writers = [
+        c.CWriter,
+        cpp.FunCppWriter,
+        python.PythonWriter,
+        ]
+
+opts = {
+        'indent': True,
+        'debug': False,
+        'auto_indent': True,
+        'stream': True,
+        }
+
+# allowed growth of the peak from the small to the large table, the
+# interpreter resizes its table of interned strings now and then
+tolerance = 1 << 20
+
+def wrapped_table(path, rows):
+    '''Writes a template with a table of rows inside of a code block'''
+    with open(path, 'w') as out:
+        out.write("? int x, int y\n%table\n  - if(x)\n")
+
+        for row in range(rows):
+            out.write("    %tr\n")
+            out.write("      %%td.name row %i\n" % row)
+            out.write("      %%td{\"class\" => \"value\"} = y\n")
+            out.write("      %td(selected?=y) text\n")
+
+def static_table(path, rows):
+    '''Writes a template with a table of rows without any dynamic output'''
+    with open(path, 'w') as out:
+        out.write("%table\n")
+
+        for row in range(rows):
+            out.write("  %tr\n")
+            out.write("    %%td.name row %i\n" % row)
+            out.write("    %td.value static\n")
+
+tables = [
+        wrapped_table,
+        static_table,
+        ]
+
+def peak_memory(writer, path, directory):
+    '''Returns the peak of memory allocated while streaming the file'''
+    tracemalloc.start()
+
+    try:
+        with open(path, 'r') as inp:
+            parser = StreamingHamlFile(inp, opts)
+            parser.execute(writer("table", directory, opts=opts))
+
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+
+    directory = tempfile.mkdtemp()
+    failed = False
+
+    try:
+        small = os.path.join(directory, "small.haml")
+        large = os.path.join(directory, "large.haml")
+
+        for table in tables:
+            table(small, rows // 10)
+            table(large, rows)
+
+            for writer in writers:
+                small_peak = peak_memory(writer, small, directory)
+                large_peak = peak_memory(writer, large, directory)
+
+                ok = large_peak - small_peak <= tolerance
+                failed = failed or not ok
+
+                print("%-14s %-8s %6i rows %8.1f KiB  %6i rows %8.1f KiB  %s"
+                        % (table.__name__, writer.IDS[0], rows // 10,
+                        small_peak / 1024, rows, large_peak / 1024,
+                        "ok" if ok else "GROWS"))
+    finally:
+        shutil.rmtree(directory)
+
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,132 @@
+###############################################################################
+##
+##  hardcode_haml - Haml for hardcore coders
+##  Copyright (C) 2010  Thammi
+## 
+##  This program is free software: you can redistribute it and/or modify
+##  it under the terms of the GNU Affero General Public License as published by
+##  the Free Software Foundation, either version 3 of the License, or
+##  (at your option) any later version.
+## 
+##  This program is distributed in the hope that it will be useful,
+##  but WITHOUT ANY WARRANTY; without even the implied warranty of
+##  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##  GNU Affero General Public License for more details.
+## 
+##  You should have received a copy of the GNU Affero General Public License
+##  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+###############################################################################
+
+import hashlib
+import json
+import os
+
+from hardcode_haml import __version__
+from hardcode_haml.deps import file_digest
+from hardcode_haml.output import replace_file
+
+# bump this when the layout of the cache file changes
+CACHE_FORMAT = 2
+
+def file_stamp(path):
+    '''Returns a cheap fingerprint of a file (size and modification time) or
+    None if it does not exist'''
+    try:
+        stat = os.stat(path)
+    except EnvironmentError:
+        return None
+
+    return [stat.st_size, stat.st_mtime_ns]
+
+class CompileCache:
+    '''Persistent record of compiled templates. A template is skipped if its
+    source, the partials it includes, the output module, the options and the
+    tool version did not change and all files written for it are still
+    untouched'''
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+
+        try:
+            with open(path, 'r') as inp:
+                data = json.load(inp)
+        except (EnvironmentError, ValueError):
+            data = None
+
+        if data and data.get('format') == CACHE_FORMAT:
+            self.entries = data['entries']
+
+    def key(self, in_file, out_module, directory, opts):
+        '''Calculate the cache key of an input file or None if it can't be
+        read'''
+        digest = hashlib.sha1()
+
+        meta = [
+                __version__,
+                out_module.__module__ + "." + out_module.__name__,
+                os.path.abspath(directory),
+                sorted(opts.items()),
+                ]
+
+        digest.update(json.dumps(meta).encode('utf-8'))
+
+        try:
+            with open(in_file, 'rb') as inp:
+                digest.update(inp.read())
+        except EnvironmentError:
+            return None
+
+        return digest.hexdigest()
+
+    def is_fresh(self, in_file, key):
+        '''Check whether the outputs of in_file are up to date'''
+        entry = self.entries.get(os.path.abspath(in_file))
+
+        if key is None or not entry or entry['key'] != key:
+            return False
+
+        for path, stamp in entry['outputs'].items():
+            if file_stamp(path) != stamp:
+                return False
+
+        for path, digest in entry.get('dependencies', {}).items():
+            if file_digest(path) != digest:
+                return False
+
+        return True
+
+    def update(self, in_file, key, outputs, segments=(), dependencies=()):
+        '''Remember the outputs written for in_file, the static segments it
+        placed in the string pool and the content of the included partials'''
+        self.entries[os.path.abspath(in_file)] = {
+                'key': key,
+                'outputs': dict((os.path.abspath(path), file_stamp(path))
+                    for path in outputs),
+                'segments': list(segments),
+                'dependencies': dict((os.path.abspath(path), file_digest(path))
+                    for path in dependencies),
+                }
+
+    def segments(self, in_file):
+        '''The pooled static segments of a fresh entry'''
+        return self.entries[os.path.abspath(in_file)].get('segments', [])
+
+    def dependencies(self, in_file):
+        '''The included partials of a fresh entry'''
+        entry = self.entries[os.path.abspath(in_file)]
+        return sorted(entry.get('dependencies', {}))
+
+    def discard(self, in_file):
+        '''Forget about in_file, it will be compiled again next time'''
+        self.entries.pop(os.path.abspath(in_file), None)
+
+    def save(self):
+        data = {
+                'format': CACHE_FORMAT,
+                'entries': self.entries,
+                }
+
+        out = json.dumps(data, indent=1, sort_keys=True)
+        replace_file(self.path, out.encode('utf-8'))
@@ -0,0 +1,74 @@
+###############################################################################
+##
+##  hardcode_haml - Haml for hardcore coders
+##  Copyright (C) 2010  Thammi
+## 
+##  This program is free software: you can redistribute it and/or modify
+##  it under the terms of the GNU Affero General Public License as published by
+##  the Free Software Foundation, either version 3 of the License, or
+##  (at your option) any later version.
+## 
+##  This program is distributed in the hope that it will be useful,
+##  but WITHOUT ANY WARRANTY; without even the implied warranty of
+##  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##  GNU Affero General Public License for more details.
+## 
+##  You should have received a copy of the GNU Affero General Public License
+##  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+###############################################################################
+
+import hashlib
+import threading
+from contextlib import contextmanager
+
+from hardcode_haml.output import replace_file
+
+# TemplateCache compiles in several threads at once, each thread only
+# records the partials included by its own template
+_local = threading.local()
+
+def _recorders():
+    '''Returns the recorders of the current thread'''
+    if not hasattr(_local, 'recorders'):
+        _local.recorders = []
+
+    return _local.recorders
+
+@contextmanager
+def collect_dependencies():
+    '''Context manager yielding a list which collects the paths of all
+    partials included inside of it in the current thread'''
+    paths = []
+    _recorders().append(paths)
+
+    try:
+        yield paths
+    finally:
+        _recorders().remove(paths)
+
+def depends(path):
+    '''Registers a file the template currently compiled depends on'''
+    for paths in _recorders():
+        if path not in paths:
+            paths.append(path)
+
+def file_digest(path):
+    '''Returns the SHA1 of the content of a file or None if it can't be
+    read'''
+    try:
+        with open(path, 'rb') as inp:
+            return hashlib.sha1(inp.read()).hexdigest()
+    except EnvironmentError:
+        return None
+
+def make_path(path):
+    '''Escapes a path for make and ninja'''
+    return path.replace(' ', '\\ ').replace('$', '$$')
+
+def write_depfile(path, targets, dependencies):
+    '''Writes a depfile in the format of make and ninja'''
+    lines = [' '.join(make_path(target) for target in targets) + ':']
+    lines += [' ' + make_path(dependency) for dependency in dependencies]
+
+    replace_file(path, (' \\\n'.join(lines) + '\n').encode('utf-8'))
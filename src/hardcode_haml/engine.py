@@ -0,0 +1,124 @@
+###############################################################################
+##
+##  hardcode_haml - Haml for hardcore coders
+##  Copyright (C) 2010  Thammi
+## 
+##  This program is free software: you can redistribute it and/or modify
+##  it under the terms of the GNU Affero General Public License as published by
+##  the Free Software Foundation, either version 3 of the License, or
+##  (at your option) any later version.
+## 
+##  This program is distributed in the hope that it will be useful,
+##  but WITHOUT ANY WARRANTY; without even the implied warranty of
+##  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##  GNU Affero General Public License for more details.
+## 
+##  You should have received a copy of the GNU Affero General Public License
+##  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+###############################################################################
+
+import hashlib
+import io
+import os
+import re
+import threading
+from collections import OrderedDict
+
+from hardcode_haml.cache import file_stamp
+from hardcode_haml.deps import collect_dependencies
+from hardcode_haml.lang.python import PythonWriter
+from hardcode_haml.names import template_name
+from hardcode_haml.parser import HamlFile
+
+default_opts = {
+        'indent': True,
+        'debug': False,
+        'auto_indent': True,
+        }
+
+def compile_template(source, name, file_name='<haml>', opts=default_opts,
+        writer=PythonWriter):
+    '''Compile Haml source into a Python function without touching the file
+    system. The function takes the output stream and the declared
+    parameters (unless another writer like PythonStrWriter is used).
+    Partials are looked up relative to file_name'''
+    name = re.sub(r'\W', '_', name)
+
+    if not name or name[0].isdigit():
+        name = '_' + name
+
+    parser = HamlFile(io.StringIO(source), dict(opts, path=file_name))
+
+    code = io.StringIO()
+    parser.execute(writer(name, None, code, opts))
+
+    namespace = {'__name__': 'haml_' + name, '__file__': file_name}
+    exec(compile(code.getvalue(), file_name, 'exec'), namespace)
+
+    return namespace[name]
+
+class TemplateCache:
+    '''Bounded LRU cache of templates compiled with compile_template(). A
+    cached template is reused as long as size and mtime of its file and the
+    included partials did not change, or if they did, as long as the content
+    of the template is the same and the partials are untouched'''
+
+    def __init__(self, maxsize=128, opts=default_opts):
+        self.maxsize = maxsize
+        self.opts = opts
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def load(self, path):
+        '''Returns the template function for the Haml file at path'''
+        path = os.path.abspath(path)
+        stamp = file_stamp(path)
+
+        with self.lock:
+            entry = self.entries.get(path)
+
+            partials = entry and all(file_stamp(partial) == partial_stamp
+                    for partial, partial_stamp in entry[3])
+
+            if partials and entry[0] == stamp:
+                self.entries.move_to_end(path)
+                return entry[2]
+
+        with open(path, 'rb') as inp:
+            data = inp.read()
+
+        digest = hashlib.sha1(data).digest()
+
+        if partials and entry[1] == digest:
+            # only touched, no need to compile again
+            function = entry[2]
+            dependencies = entry[3]
+        else:
+            with collect_dependencies() as included:
+                function = compile_template(data.decode('utf-8'),
+                        template_name(path), path, self.opts)
+
+            dependencies = [(partial, file_stamp(partial))
+                    for partial in included]
+
+        with self.lock:
+            self.entries[path] = (stamp, digest, function, dependencies)
+            self.entries.move_to_end(path)
+
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+        return function
+
+    def clear(self):
+        '''Drop all cached templates'''
+        with self.lock:
+            self.entries.clear()
+
+default_cache = TemplateCache()
+
+def load_template(path):
+    '''Returns the compiled template function for the Haml file at path using
+    the default cache'''
+    return default_cache.load(path)
@@ -0,0 +1,301 @@
+###############################################################################
+##
+##  hardcode_haml - Haml for hardcore coders
+##  Copyright (C) 2010  Thammi
+## 
+##  This program is free software: you can redistribute it and/or modify
+##  it under the terms of the GNU Affero General Public License as published by
+##  the Free Software Foundation, either version 3 of the License, or
+##  (at your option) any later version.
+## 
+##  This program is distributed in the hope that it will be useful,
+##  but WITHOUT ANY WARRANTY; without even the implied warranty of
+##  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##  GNU Affero General Public License for more details.
+## 
+##  You should have received a copy of the GNU Affero General Public License
+##  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+###############################################################################
+
+from hardcode_haml.primitives import escape_html
+
+# kinds of recorded operations, blocks carry their header and a list of
+# operations
+WRITE = 'write'
+EVALUATE = 'evaluate'
+EXECUTE = 'execute'
+COMMENT = 'comment'
+CONDITIONAL = 'conditional'
+BLOCK = 'block'
+
+# static text is passed on and flushed once this many characters came
+# together, so streaming keeps memory flat for large static templates
+STATIC_LIMIT = 1 << 16
+
+# how close_block() finishes the open blocks
+PASSED = 'passed'
+RECORDED = 'recorded'
+INLINED = 'inlined'
+DEAD = 'dead'
+
+def remove_empty(ops):
+    '''Removes conditional blocks without any output, their comments are
+    kept'''
+    result = []
+
+    for op in ops:
+        if op[0] == CONDITIONAL:
+            body = remove_empty(op[2])
+
+            if all(inner[0] == COMMENT for inner in body):
+                result.extend(body)
+                continue
+
+            op = (CONDITIONAL, op[1], body)
+        elif op[0] == BLOCK:
+            op = (BLOCK, op[1], remove_empty(op[2]))
+
+        result.append(op)
+
+    return result
+
+def merge_static(ops):
+    '''Merges adjacent static text into operations of up to STATIC_LIMIT
+    characters. Comments in between are moved in front of the merged
+    text'''
+    result = []
+    comments = []
+    texts = []
+    size = 0
+
+    def dump():
+        result.extend(comments)
+        del comments[:]
+
+        data = ''.join(texts)
+        del texts[:]
+
+        if data:
+            result.append((WRITE, data))
+
+    for op in ops:
+        kind = op[0]
+
+        if kind == WRITE:
+            if size + len(op[1]) > STATIC_LIMIT:
+                dump()
+                size = 0
+
+            texts.append(op[1])
+            size += len(op[1])
+        elif kind == COMMENT and texts:
+            comments.append(op)
+        else:
+            dump()
+            size = 0
+
+            if kind in (CONDITIONAL, BLOCK):
+                op = (kind, op[1], merge_static(op[2]))
+
+            result.append(op)
+
+    dump()
+
+    return result
+
+def replay(ops, out):
+    '''Writes the operations into the output module'''
+    for op in ops:
+        kind = op[0]
+
+        if kind == WRITE:
+            out.write(op[1])
+        elif kind == EVALUATE:
+            out.evaluate(op[1], op[2])
+        elif kind == EXECUTE:
+            out.execute(op[1])
+        elif kind == COMMENT:
+            out.comment(op[1])
+        else:
+            if kind == CONDITIONAL:
+                out.conditional_block(op[1])
+            else:
+                out.block_exec(op[1])
+
+            replay(op[2], out)
+            out.close_block()
+
+class IRBuilder:
+    '''Takes the calls of the parser like an output module and passes them
+    on optimized: literal evaluations become static text, conditional
+    blocks with literal conditions are decided and static text is merged
+    across comments. Everything is passed on as soon as the next dynamic
+    operation arrives, only undecided conditional blocks (boolean
+    attributes) are recorded until they are closed to drop them if they
+    turn out empty, so streaming keeps working'''
+
+    def __init__(self, out):
+        self.out = out
+
+        # static text not passed on yet and comments written in between
+        self.texts = []
+        self.size = 0
+        self.comments = []
+
+        # one entry for each open block
+        self.closing = []
+
+        # operations of the undecided conditional block being recorded
+        self.ops = None
+        self.parents = []
+        self.recorded = None
+
+        # depth of blocks inside a conditional block which is never run
+        self.dead = 0
+
+    def dump(self):
+        '''Pass on the collected static text, the comments go first'''
+        out = self.out
+
+        for data in self.comments:
+            out.comment(data)
+
+        self.comments = []
+
+        data = ''.join(self.texts)
+        self.texts = []
+        self.size = 0
+
+        if data:
+            out.write(data)
+
+    def start(self):
+        self.out.start()
+
+    def declare(self, paras):
+        self.dump()
+        self.out.declare(paras)
+
+    def evaluate(self, cmd, escape=False):
+        if self.dead:
+            return
+
+        text = self.out.fold_text(cmd)
+
+        if text != None:
+            self.write(escape_html(text) if escape else text)
+        elif self.ops != None:
+            self.ops.append((EVALUATE, cmd, escape))
+        else:
+            self.dump()
+            self.out.evaluate(cmd, escape)
+
+    def execute(self, cmd):
+        if self.dead:
+            return
+
+        if self.ops != None:
+            self.ops.append((EXECUTE, cmd))
+        else:
+            self.dump()
+            self.out.execute(cmd)
+
+    def write(self, data):
+        if self.dead:
+            return
+
+        if self.ops != None:
+            self.ops.append((WRITE, data))
+            return
+
+        self.texts.append(data)
+        self.size += len(data)
+
+        # the writers collect static text until they are flushed, too
+        if self.size > STATIC_LIMIT:
+            self.flush()
+
+    def flush(self):
+        self.dump()
+        self.out.flush()
+
+    def record(self, kind, header):
+        '''Record the following operations as body of a block'''
+        body = []
+
+        if self.ops != None:
+            self.ops.append((kind, header, body))
+        else:
+            self.recorded = header
+
+        self.parents.append(self.ops)
+        self.ops = body
+        self.closing.append(RECORDED)
+
+    def conditional_block(self, expression):
+        condition = None if self.dead else self.out.fold_condition(expression)
+
+        if self.dead or condition == False:
+            self.dead += 1
+            self.closing.append(DEAD)
+        elif condition == True:
+            self.closing.append(INLINED)
+        else:
+            self.record(CONDITIONAL, expression)
+
+    def block_exec(self, cmd):
+        if self.dead:
+            self.dead += 1
+            self.closing.append(DEAD)
+        elif self.ops != None:
+            self.record(BLOCK, cmd)
+        else:
+            self.dump()
+            self.out.block_exec(cmd)
+            self.closing.append(PASSED)
+
+    def close_block(self):
+        kind = self.closing.pop()
+
+        if kind == DEAD:
+            self.dead -= 1
+        elif kind == PASSED:
+            self.dump()
+            self.out.close_block()
+        elif kind == RECORDED:
+            body = self.ops
+            self.ops = self.parents.pop()
+
+            if self.ops == None:
+                self.write_conditional(self.recorded, body)
+
+    def write_conditional(self, expression, body):
+        '''Pass on a recorded conditional block unless it has no output'''
+        body = merge_static(remove_empty(body))
+
+        if all(op[0] == COMMENT for op in body):
+            for op in body:
+                self.comment(op[1])
+
+            return
+
+        self.dump()
+        self.out.conditional_block(expression)
+        replay(body, self.out)
+        self.out.close_block()
+
+    def comment(self, data):
+        if self.dead:
+            return
+
+        if self.ops != None:
+            self.ops.append((COMMENT, data))
+        elif self.texts:
+            self.comments.append(data)
+        else:
+            self.out.comment(data)
+
+    def finish(self):
+        self.dump()
+        self.out.finish()
@@ -19,42 +19,362 @@
 ###############################################################################
 
 from os.path import join
+import re
+import shutil
+import tempfile
 
-from hardcode_haml import primitives
+from hardcode_haml import pool, primitives
+from hardcode_haml.output import OutputFile, write_shared
+from hardcode_haml.parser import ParserException
+
+simple_escapes = {
+        '\\': '\\\\',
+        '"': '\\"',
+        '\n': '\\n',
+        '\r': '\\r',
+        }
+
+unsafe_re = re.compile(r'[\\"\x00-\x08\x0a-\x1f]')
+
+def escape_literal(data):
+    '''Escape text to be placed in a C string literal'''
+    def replace(match):
+        char = match.group()
+
+        if char in simple_escapes:
+            return simple_escapes[char]
+        else:
+            # always three digits, the next character might be a digit
+            return '\\%03o' % ord(char)
+
+    return unsafe_re.sub(replace, data)
+
+def escape_table():
+    '''Rows of the C initializer mapping each byte to the index of its
+    entity, 0 if it is written as it is and a sentinel for the NUL byte'''
+    entities = list(primitives.html_escapes)
+    codes = [0] * 256
+    codes[0] = len(entities) + 1
+
+    for index, char in enumerate(entities):
+        codes[ord(char)] = index + 1
+
+    return ['\t' + ', '.join(str(code) for code in codes[row:row+16]) + ','
+            for row in range(0, 256, 16)]
+
+escape_header = '''\
+#ifndef HAMLESCAPE_H
+#define HAMLESCAPE_H
+
+#include <stddef.h>
+#include <string.h>
+
+/* the writers using a sink instead of a FILE define HAML_NO_STDIO */
+#ifndef HAML_NO_STDIO
+#include <stdio.h>
+#endif
+
+/* index into haml_entities for each byte, 0 for safe bytes */
+static const unsigned char haml_escape_table[256] = {
+%(table)s
+};
+
+static const char *const haml_entities[] = {
+\t"", %(entities)s
+};
+
+static const unsigned char haml_entity_lengths[] = {
+\t0, %(lengths)s
+};
+
+typedef void (*haml_sink)(void *ctx, const char *data, size_t len);
+
+/* passes runs of safe bytes to the sink at once and entities for others */
+static inline void haml_escape_to(haml_sink sink, void *ctx, const char *str) {
+\tconst unsigned char *pos = (const unsigned char *) str;
+\tconst unsigned char *run = pos;
+\tunsigned char code;
+
+\tfor(;;) {
+\t\twhile(!haml_escape_table[*pos]) {
+\t\t\tpos++;
+\t\t}
+
+\t\tif(pos != run) {
+\t\t\tsink(ctx, (const char *) run, pos - run);
+\t\t}
+
+\t\tif(!*pos) {
+\t\t\treturn;
+\t\t}
+
+\t\tcode = haml_escape_table[*pos];
+\t\tsink(ctx, haml_entities[code], haml_entity_lengths[code]);
+\t\trun = ++pos;
+\t}
+}
+
+#ifndef HAML_NO_STDIO
+
+static inline void haml_file_sink(void *ctx, const char *data, size_t len) {
+\tfwrite(data, 1, len, (FILE *) ctx);
+}
+
+static inline void haml_escape(const char *str, FILE *out) {
+\thaml_escape_to(haml_file_sink, out, str);
+}
+
+#endif
+
+struct haml_buf {
+\tchar *buf;
+\tsize_t cap;
+\tsize_t pos;
+};
+
+static inline void haml_buf_sink(void *ctx, const char *data, size_t len) {
+\tstruct haml_buf *buf = (struct haml_buf *) ctx;
+
+\tif(buf->pos < buf->cap) {
+\t\tsize_t room = buf->cap - buf->pos;
+\t\tmemcpy(buf->buf + buf->pos, data, len < room ? len : room);
+\t}
+
+\tbuf->pos += len;
+}
+
+static inline size_t haml_escape_buf(char *buf, size_t cap, size_t pos,
+\t\tconst char *str) {
+\tstruct haml_buf state = { buf, cap, pos };
+\thaml_escape_to(haml_buf_sink, &state, str);
+\treturn state.pos;
+}
+
+#ifdef __cplusplus
+
+#include <ostream>
+#include <sstream>
+#include <string>
+
+namespace haml {
+
+inline void ostream_sink(void *ctx, const char *data, size_t len) {
+\tstatic_cast<std::ostream *>(ctx)->write(data, len);
+}
+
+inline void string_sink(void *ctx, const char *data, size_t len) {
+\tstatic_cast<std::string *>(ctx)->append(data, len);
+}
+
+inline void escape(std::ostream &out, const char *str) {
+\thaml_escape_to(ostream_sink, &out, str);
+}
+
+inline void escape(std::string &out, const char *str) {
+\thaml_escape_to(string_sink, &out, str);
+}
+
+inline void escape(std::ostream &out, const std::string &str) {
+\tescape(out, str.c_str());
+}
+
+inline void escape(std::string &out, const std::string &str) {
+\tescape(out, str.c_str());
+}
+
+template<class T>
+inline void escape(std::ostream &out, const T &value) {
+\tstd::ostringstream tmp;
+\ttmp << value;
+\tescape(out, tmp.str());
+}
+
+template<class T>
+inline void escape(std::string &out, const T &value) {
+\tstd::ostringstream tmp;
+\ttmp << value;
+\tescape(out, tmp.str());
+}
+
+}
+
+#endif
+
+#endif /* HAMLESCAPE_H */
+''' % {
+        'table': '\n'.join(escape_table()),
+        'entities': ', '.join('"%s"' % entity
+            for entity in primitives.html_escapes.values()),
+        'lengths': ', '.join(str(len(entity))
+            for entity in primitives.html_escapes.values()),
+        }
+
+def c_literal(data, opts):
+    '''Returns the expression used to reference static text, either a
+    string literal or the symbol in the string pool'''
+    if opts.get('pool'):
+        return pool.pooled(data)
+    else:
+        return '"' + escape_literal(data) + '"'
+
+def literal_length(data):
+    '''Returns the length in bytes of the text in the generated file'''
+    return len(data.encode('utf-8'))
 
 class CWriter:
 
     IDS = ['c']
     NAME = "C using functions"
+    STRING_POOL = True
 
-    def __init__(self, name, directory):
+    # hooks for the different output sinks
+    HEADER = "#include <stdio.h>\n\n"
+    STDIO = True
+    RESULT = 'void'
+    SINK_PARAS = ['FILE *out']
+    LOCALS = []
+    EPILOGUE = []
+    RETURN = None
+    LITERAL = 'fwrite({literal}, 1, {length}, out)'
+    STRING = 'fputs({cmd}, out)'
+    ESCAPED = 'haml_escape({cmd}, out)'
+
+    def __init__(self, name, directory, opts=None):
         file_name = join(directory, name + ".c")
-        self.out = open(file_name, 'w')
+        self.file = OutputFile(file_name)
+        self.out = self.file
         self.write_buf = []
         self.name = name
+        self.directory = directory
+        self.opts = opts or {}
+        self.escaping = False
+
+        # static text at the start and the end is exported as constants,
+        # they are declared in the header
+        self.constants = not self.opts.get('pool')
+        self.dynamic = False
+        self.decl = None
+        self.externs = []
 
     def start(self):
-        self.out.write("#include <stdio.h>\n\n")
+        self.out.write(self.HEADER)
+        self.out.write('#include "{name}.h"\n'.format(name=self.name))
+
+        if self.opts.get('pool'):
+            self.out.write('#include "{name}.h"\n'.format(name=pool.POOL_NAME))
 
         self.indent = 0
 
     def finish(self):
-        self.flush()
-        self.out.write("}\n")
+        data = ''.join(self.write_buf)
+        self.write_buf = []
+
+        if not data:
+            last = None
+        elif not self.constants:
+            last = c_literal(data, self.opts)
+        elif self.dynamic:
+            last = self.export('suffix', data)
+        else:
+            last = self.export('static', data)
+
+        if self.decl == None:
+            raise ParserException("The template was never declared", None)
+
+        # the body is complete, assemble the function
+        out = self.file
+
+        if self.escaping:
+            write_shared(self.directory, "hamlescape.h", escape_header)
+
+            if not self.STDIO:
+                out.write('\n#define HAML_NO_STDIO')
+
+            out.write('\n#include "hamlescape.h"\n')
+
+        out.write(self.decl)
+
+        for local in self.LOCALS:
+            out.write("\t" + local + ";\n")
+
+        self.out.seek(0)
+        shutil.copyfileobj(self.out, out)
+        self.out.close()
+
+        if last:
+            fstr = "\t" + self.LITERAL + ";\n"
+            out.write(fstr.format(literal=last, length=literal_length(data)))
+
+        for line in self.EPILOGUE:
+            out.write("\t" + line + ";\n")
+
+        if self.RETURN:
+            out.write("\treturn {value};\n".format(value=self.RETURN))
+
+        out.write("}\n")
+        out.close()
+
+        self.write_header()
+
+    def write_header(self):
+        '''Writes the header declaring the exported constants'''
+        header = OutputFile(join(self.directory, self.name + ".h"))
+        gate = self.name.upper() + "_H"
+
+        header.write("#ifndef {gate}\n".format(gate=gate))
+        header.write("#define {gate}\n\n".format(gate=gate))
+        header.write("#include <stddef.h>\n")
+
+        if self.externs:
+            header.write("\n")
+
+        for extern in self.externs:
+            header.write(extern)
+
+        header.write("\n#endif\n")
+        header.close()
 
     def declare(self, paras):
-        para_str = ', '.join(['FILE *out'] + paras)
-        dec_f = "\nvoid {name}({para}) {{\n"
-        self.out.write(dec_f.format(name=self.name, para=para_str))
+        para_str = ', '.join(self.SINK_PARAS + paras)
+        dec_f = "\n{result} {name}({para}) {{\n"
+        self.decl = dec_f.format(result=self.RESULT, name=self.name,
+            para=para_str)
+
+        # constants are defined in front of the function, so the body is
+        # kept aside until it is complete
+        self.out = tempfile.TemporaryFile('w+', encoding='utf-8')
+        self.dynamic = False
+
         self.indent += 1
 
-    def evaluate(self, cmd):
-        prim = primitives.find_primitive(cmd)
+    def export(self, kind, data):
+        '''Defines a constant holding static text, returns its name'''
+        name = "{name}_{kind}".format(name=self.name, kind=kind)
+
+        fstr = '\nconst char {name}[] = "{data}";\n'
+        self.file.write(fstr.format(name=name, data=escape_literal(data)))
+
+        fstr = 'const size_t {name}_len = {length};\n'
+        self.file.write(fstr.format(name=name, length=literal_length(data)))
 
-        if prim:
-            self.write_buf.append(prim)
+        fstr = 'extern const char {name}[];\nextern const size_t {name}_len;\n'
+        self.externs.append(fstr.format(name=name))
+
+        return name
+
+    def evaluate(self, cmd, escape=False):
+        # literals were already folded into static text by the IR
+        if escape:
+            self.escaping = True
+            self.execute(self.ESCAPED.format(cmd=cmd))
         else:
-            self.execute("fputs({cmd}, out)".format(cmd=cmd))
+            self.execute(self.STRING.format(cmd=cmd))
+
+    def fold_text(self, cmd):
+        return primitives.c_text(cmd)
+
+    def fold_condition(self, expression):
+        return primitives.c_condition(expression)
 
     def execute(self, cmd):
         self.flush()
@@ -62,43 +382,221 @@ class CWriter:
         cmd = cmd.strip()
 
         if cmd.startswith('#'):
-            self.out.write(cmd + "\n")
+            self.emit(cmd + "\n")
         else:
-            self.out.write("\t" * self.indent + cmd + ";\n")
+            self.emit("\t" * self.indent + cmd + ";\n")
 
-    def write(self, data):
-        # escape!
-        replacements = [
-                ('\\', '\\\\'),
-                ('\n', '\\n'),
-                ('"', '\\"'),
-                ]
-        
-        for old, new in replacements:
-            data = data.replace(old, new)
+    def emit(self, code):
+        self.dynamic = True
+        self.out.write(code)
 
+    def write(self, data):
+        # escaped when flushing
         self.write_buf.append(data)
 
     def flush(self):
         if self.write_buf:
             data = ''.join(self.write_buf)
             self.write_buf = []
-            self.execute('fputs("{data}", out)'.format(data=data))
+
+            if not data:
+                return
+
+            if self.constants and self.decl and not self.dynamic:
+                literal = self.export('prefix', data)
+            else:
+                literal = c_literal(data, self.opts)
+
+            self.execute(self.LITERAL.format(literal=literal,
+                length=literal_length(data)))
 
     def conditional_block(self, expression):
         self.block_exec("if({expr})".format(expr=expression))
 
     def block_exec(self, cmd):
         self.flush()
-        self.out.write("\t" * self.indent + cmd + " {\n")
+        self.emit("\t" * self.indent + cmd + " {\n")
         self.indent += 1
 
     def close_block(self):
         self.flush()
         self.indent -= 1
-        self.out.write("\t" * self.indent + "}\n")
+        self.emit("\t" * self.indent + "}\n")
 
     def comment(self, data):
         self.flush()
-        self.out.write("\t" * self.indent + "// " + data + "\n")
+        self.emit("\t" * self.indent + "// " + data + "\n")
+
+
+class CCallbackWriter(CWriter):
+    '''Writes through a callback instead of stdio'''
+
+    IDS = ['c-callback']
+    NAME = "C using a write callback"
+    STDIO = False
+
+    HEADER = """#include <stddef.h>
+#include <string.h>
+
+typedef void (*haml_write_cb)(void *ctx, const char *data, size_t len);
+
+static inline void haml_puts(haml_write_cb haml_write, void *haml_ctx,
+\t\tconst char *str) {
+\thaml_write(haml_ctx, str, strlen(str));
+}
+"""
+    SINK_PARAS = ['haml_write_cb haml_write', 'void *haml_ctx']
+    LITERAL = 'haml_write(haml_ctx, {literal}, {length})'
+    STRING = 'haml_puts(haml_write, haml_ctx, {cmd})'
+    ESCAPED = 'haml_escape_to(haml_write, haml_ctx, {cmd})'
+
+
+class CBufferWriter(CWriter):
+    '''Writes into a caller supplied buffer
+
+    Like snprintf() the output is terminated with a NUL byte if the
+    capacity is not 0 and the function returns the length of the whole
+    output without it, a result not smaller than the capacity means the
+    output was truncated.
+    '''
+
+    IDS = ['c-buffer']
+    NAME = "C writing into a buffer"
+    STDIO = False
+
+    HEADER = """#include <stddef.h>
+#include <string.h>
 
+static inline size_t haml_buf_write(char *buf, size_t cap, size_t pos,
+\t\tconst char *data, size_t len) {
+\tif(pos < cap) {
+\t\tsize_t room = cap - pos;
+\t\tmemcpy(buf + pos, data, len < room ? len : room);
+\t}
+
+\treturn pos + len;
+}
+
+static inline size_t haml_buf_puts(char *buf, size_t cap, size_t pos,
+\t\tconst char *str) {
+\treturn haml_buf_write(buf, cap, pos, str, strlen(str));
+}
+"""
+    RESULT = 'size_t'
+    SINK_PARAS = ['char *haml_buf', 'size_t haml_cap']
+    LITERAL = ('haml_len = haml_buf_write(haml_buf, haml_cap, haml_len, '
+            '{literal}, {length})')
+    STRING = 'haml_len = haml_buf_puts(haml_buf, haml_cap, haml_len, {cmd})'
+    ESCAPED = 'haml_len = haml_escape_buf(haml_buf, haml_cap, haml_len, {cmd})'
+    LOCALS = ['size_t haml_len = 0']
+    EPILOGUE = ['if(haml_cap) haml_buf[haml_len < haml_cap ? haml_len : '
+            'haml_cap - 1] = 0']
+    RETURN = 'haml_len'
+
+class CIovecWriter(CWriter):
+    '''Fills a caller supplied iovec array for writev() without copying
+
+    The entries point at the static text and at the evaluated strings, so
+    those have to stay valid until the flush callback got them. The callback
+    is called whenever the array is full and once at the end. If the number
+    of entries is bounded at compile time the maximum is exported as
+    name_iovcnt.
+    '''
+
+    IDS = ['c-iovec']
+    NAME = "C filling iovec arrays for writev()"
+    STDIO = False
+
+    HEADER = """#include <stddef.h>
+#include <string.h>
+#include <sys/uio.h>
+
+typedef void (*haml_iov_flush)(void *ctx, const struct iovec *iov, int count);
+
+struct haml_iovs {
+\tstruct iovec *iov;
+\tint cap;
+\tint count;
+\thaml_iov_flush flush;
+\tvoid *ctx;
+};
+
+static inline void haml_iov_push(struct haml_iovs *iovs, const char *data,
+\t\tsize_t len) {
+\tif(iovs->count == iovs->cap) {
+\t\tiovs->flush(iovs->ctx, iovs->iov, iovs->count);
+\t\tiovs->count = 0;
+\t}
+
+\tiovs->iov[iovs->count].iov_base = (void *) data;
+\tiovs->iov[iovs->count].iov_len = len;
+\tiovs->count++;
+}
+
+static inline void haml_iov_puts(struct haml_iovs *iovs, const char *str) {
+\thaml_iov_push(iovs, str, strlen(str));
+}
+
+static inline void haml_iov_sink(void *ctx, const char *data, size_t len) {
+\thaml_iov_push((struct haml_iovs *) ctx, data, len);
+}
+
+static inline void haml_iov_finish(struct haml_iovs *iovs) {
+\tif(iovs->count) {
+\t\tiovs->flush(iovs->ctx, iovs->iov, iovs->count);
+\t}
+}
+"""
+    SINK_PARAS = ['struct iovec *haml_iov', 'int haml_iov_cap',
+            'haml_iov_flush haml_flush', 'void *haml_ctx']
+    LITERAL = 'haml_iov_push(&haml_iovs, {literal}, {length})'
+    STRING = 'haml_iov_puts(&haml_iovs, {cmd})'
+    ESCAPED = 'haml_escape_to(haml_iov_sink, &haml_iovs, {cmd})'
+    LOCALS = ['struct haml_iovs haml_iovs = '
+            '{ haml_iov, haml_iov_cap, 0, haml_flush, haml_ctx }']
+    EPILOGUE = ['haml_iov_finish(&haml_iovs)']
+
+    def __init__(self, name, directory, opts=None):
+        CWriter.__init__(self, name, directory, opts)
+
+        # entries pushed, None once loops or escaping make it unknown
+        self.iovcnt = 0
+
+    def count(self, entries):
+        if self.iovcnt != None:
+            self.iovcnt += entries
+
+    def finish(self):
+        if ''.join(self.write_buf):
+            self.count(1)
+
+        if self.iovcnt != None:
+            fstr = '\nconst size_t {name}_iovcnt = {count};\n'
+            self.file.write(fstr.format(name=self.name, count=self.iovcnt))
+
+            fstr = 'extern const size_t {name}_iovcnt;\n'
+            self.externs.append(fstr.format(name=self.name))
+
+        CWriter.finish(self)
+
+    def evaluate(self, cmd, escape=False):
+        if escape:
+            self.iovcnt = None
+        else:
+            self.count(1)
+
+        CWriter.evaluate(self, cmd, escape)
+
+    def flush(self):
+        if ''.join(self.write_buf):
+            self.count(1)
+
+        CWriter.flush(self)
+
+    def block_exec(self, cmd):
+        # conditional blocks only lower the count, others might loop
+        self.iovcnt = None
+        CWriter.block_exec(self, cmd)
+
+    def conditional_block(self, expression):
+        CWriter.block_exec(self, "if({expr})".format(expr=expression))
@@ -18,51 +18,154 @@
 ##
 ###############################################################################
 
-from os.path import join, exists
+from os.path import join
 import re
 
-from hardcode_haml import primitives
+from hardcode_haml import pool, primitives
+from hardcode_haml.lang.c import c_literal, escape_header, escape_literal, \
+        literal_length
+from hardcode_haml.output import OutputFile, write_shared
+from hardcode_haml.parser import ParserException
+
+para_name_re = re.compile(r'(\w+)\s*(?:\[[^\]]*\]\s*)*$')
+
+def para_name(para):
+    '''Returns the name of the variable declared in a parameter'''
+    return para_name_re.search(para).group(1)
+
+sink_header = '''\
+#ifndef HAMLSINK_H
+#define HAMLSINK_H
+
+#include <cstddef>
+#include <ostream>
+#include <sstream>
+#include <string>
+
+namespace haml {
+
+inline void write(std::ostream &out, const char *data, std::size_t len) {
+\tout.write(data, len);
+}
+
+inline void write(std::string &out, const char *data, std::size_t len) {
+\tout.append(data, len);
+}
+
+template<class T>
+inline void print(std::ostream &out, const T &value) {
+\tout << value;
+}
+
+inline void print(std::string &out, const char *value) {
+\tout.append(value);
+}
+
+inline void print(std::string &out, const std::string &value) {
+\tout.append(value);
+}
+
+inline void print(std::string &out, char value) {
+\tout.push_back(value);
+}
+
+template<class T>
+inline void print(std::string &out, const T &value) {
+\tstd::ostringstream tmp;
+\ttmp << value;
+\tout.append(tmp.str());
+}
+
+}
+
+#endif /* HAMLSINK_H */
+'''
 
 class AbstractCppWriter:
 
-    def __init__(self, name, directory):
+    # static text may be placed in the shared string pool
+    STRING_POOL = True
+
+    # the sources of several templates may be included in one unity file
+    UNITY_BUILD = True
+
+    def __init__(self, name, directory, opts=None):
         self.write_buf = []
         self.name = name
         self.directory = directory
+        self.opts = opts or {}
+        self.escaping = False
+
+        # templated body writing into std::ostream and std::string
+        self.string_sink = self.opts.get('string_sink', False)
+
+        # static text at the start and the end is exported as constants
+        self.constants = not self.opts.get('pool')
+        self.exports = []
+        self.dynamic = False
+        self.declared = False
 
     def to_file(self, out_str):
         if self.header:
             self.header.write(out_str)
         else:
+            self.dynamic = True
             self.out.write(out_str)
 
+    def end_declare(self):
+        '''Called by declare() once the header contains the declaration, the
+        header is completed in finish()'''
+        self.h_file = self.header
+        self.header = None
+        self.declared = True
 
     def start(self):
         directory = self.directory
         name = self.name
 
-        self.out = open(join(directory, name + ".cpp"), 'w')
-        self.header = open(join(directory, name + ".h"), 'w')
+        self.out = OutputFile(join(directory, name + ".cpp"))
+        self.header = OutputFile(join(directory, name + ".h"))
 
-        inc_f = '#include <iostream>\n#include "{name}.h"\n\n'
+        inc_f = '#include <iostream>\n#include "{name}.h"\n'
         self.out.write(inc_f.format(name=name))
 
+        if self.opts.get('pool'):
+            inc_f = '#include "{name}.h"\n'
+            self.out.write(inc_f.format(name=pool.POOL_NAME))
+
+        self.out.write("\n")
+
         gate = self.name.upper() + "_H"
 
         self.header.write("#ifndef {gate}\n".format(gate=gate))
         self.header.write("#define {gate}\n\n".format(gate=gate))
-        self.header.write("#include <iostream>\n\n")
+        self.header.write("#include <iostream>\n")
 
-        self.indent = 0
+        if self.string_sink:
+            write_shared(directory, "hamlsink.h", sink_header)
+            self.header.write('#include <string>\n#include "hamlsink.h"\n')
 
-    def evaluate(self, cmd):
-        prim = primitives.find_primitive(cmd)
+        self.header.write("\n")
 
-        if prim:
-            self.write_buf.append(prim)
+        self.indent = 0
+
+    def evaluate(self, cmd, escape=False):
+        # literals were already folded into static text by the IR
+        if escape:
+            self.escaping = True
+            self.execute("haml::escape(out, {cmd})".format(cmd=cmd))
+        elif self.string_sink:
+            self.execute("haml::print(out, {cmd})".format(cmd=cmd))
         else:
             self.execute("out << ({cmd})".format(cmd=cmd))
 
+    def fold_text(self, cmd):
+        # the default formatting of std::ostream is known for floats
+        return primitives.c_text(cmd, floats=True)
+
+    def fold_condition(self, expression):
+        return primitives.c_condition(expression)
+
     def execute(self, cmd):
         self.flush()
 
@@ -76,23 +179,78 @@ class AbstractCppWriter:
         self.to_file(out_str)
 
     def write(self, data):
-        # escape!
-        replacements = [
-                ('\\', '\\\\'),
-                ('\n', '\\n'),
-                ('"', '\\"'),
-                ]
-        
-        for old, new in replacements:
-            data = data.replace(old, new)
-
+        # escaped when flushing
         self.write_buf.append(data)
 
     def flush(self):
         if self.write_buf:
             data = ''.join(self.write_buf)
             self.write_buf = []
-            self.execute('out << "{data}"'.format(data=data))
+
+            if not data:
+                return
+
+            if self.constants and self.declared and not self.dynamic:
+                literal = self.export('prefix', data)
+            else:
+                literal = c_literal(data, self.opts)
+
+            self.write_literal(literal, data)
+
+    def write_literal(self, literal, data):
+        if self.string_sink:
+            fstr = 'haml::write(out, {literal}, {length})'
+        else:
+            fstr = 'out.write({literal}, {length})'
+
+        self.execute(fstr.format(literal=literal, length=literal_length(data)))
+
+    def export(self, kind, data):
+        '''Remembers a constant holding static text, returns its name'''
+        name = "{name}_{kind}".format(name=self.name, kind=kind)
+        self.exports.append((name, data))
+        return name
+
+    def finish(self):
+        if not self.declared:
+            raise ParserException("The template was never declared", None)
+
+        data = ''.join(self.write_buf)
+        self.write_buf = []
+
+        if not data:
+            pass
+        elif not self.constants:
+            self.write_literal(c_literal(data, self.opts), data)
+        elif self.dynamic:
+            self.write_literal(self.export('suffix', data), data)
+        else:
+            self.write_literal(self.export('static', data), data)
+
+        self.out.write("}\n")
+
+        if self.escaping:
+            write_shared(self.directory, "hamlescape.h", escape_header)
+            self.h_file.write('\n#include "hamlescape.h"\n')
+
+        # the constants are declared in the header and defined after the body
+        if self.exports:
+            self.h_file.write("\n")
+
+        for name, data in self.exports:
+            fstr = '\nconst char {name}[] = "{data}";\n'
+            self.out.write(fstr.format(name=name, data=escape_literal(data)))
+
+            fstr = 'const std::size_t {name}_len = {length};\n'
+            self.out.write(fstr.format(name=name, length=literal_length(data)))
+
+            fstr = 'extern const char {name}[];\nextern const std::size_t {name}_len;\n'
+            self.h_file.write(fstr.format(name=name))
+
+        self.h_file.write("\n#endif\n")
+        self.h_file.close()
+
+        self.out.close()
 
     def conditional_block(self, expression):
         self.block_exec("if({expr})".format(expr=expression))
@@ -117,21 +275,41 @@ class FunCppWriter(AbstractCppWriter):
     NAME = "C++ using functions"
 
     def declare(self, paras):
-        para_str = ', '.join(['std::ostream &out'] + paras)
-        decl = "void {name}({para})".format(name=self.name, para=para_str)
-
-        self.out.write("\n{decl} {{\n".format(decl=decl))
+        if self.string_sink:
+            self.declare_sinks(paras)
+        else:
+            para_str = ', '.join(['std::ostream &out'] + paras)
+            decl = "void {name}({para})".format(name=self.name, para=para_str)
 
-        self.header.write("\n{decl};\n\n#endif\n".format(decl))
+            self.out.write("\n{decl} {{\n".format(decl=decl))
+            self.header.write("{decl};\n".format(decl=decl))
 
-        self.header.close()
-        self.header = None
+        self.end_declare()
 
         self.indent += 1
 
-    def finish(self):
-        self.flush()
-        self.out.write("}}\n")
+    def declare_sinks(self, paras):
+        name = self.name
+
+        render_para = ', '.join(['Out &out'] + paras)
+        render_decl = "template<class Out>\nstatic void {name}_render({para})"
+        render_decl = render_decl.format(name=name, para=render_para)
+
+        self.out.write("\n{decl};\n".format(decl=render_decl))
+
+        # the wrappers instantiate the body for each sink
+        arg_str = ', '.join(['out'] + [para_name(para) for para in paras])
+
+        for sink in ['std::ostream', 'std::string']:
+            para_str = ', '.join([sink + ' &out'] + paras)
+            decl = "void {name}({para})".format(name=name, para=para_str)
+
+            self.header.write("{decl};\n".format(decl=decl))
+
+            fstr = "\n{decl} {{\n\t{name}_render({args});\n}}\n"
+            self.out.write(fstr.format(decl=decl, name=name, args=arg_str))
+
+        self.out.write("\n{decl} {{\n".format(decl=render_decl))
 
 template_header = '''\
 #ifndef HAMLTEMPLATE_H
@@ -156,11 +334,7 @@ class ClassCppWriter(AbstractCppWriter):
     NAME = "C++ using classes"
 
     def declare(self, paras):
-        th_file = join(self.directory, "hamltemplate.h")
-        if not exists(th_file):
-            th_out = open(th_file, 'w')
-            th_out.write(template_header)
-            th_out.close()
+        write_shared(self.directory, "hamltemplate.h", template_header)
 
         h_write = self.header.write
         o_write = self.out.write
@@ -172,7 +346,15 @@ class ClassCppWriter(AbstractCppWriter):
         para_str = ', '.join(paras)
 
         # writing into the .cpp
-        o_write("void %s::run(std::ostream &out) {\n" % class_name)
+        if self.string_sink:
+            for sink in ['std::ostream', 'std::string']:
+                fstr = "void {name}::run({sink} &out) {{\n\trender(out);\n}}\n\n"
+                o_write(fstr.format(name=class_name, sink=sink))
+
+            o_write("template<class Out>\n")
+            o_write("void %s::render(Out &out) {\n" % class_name)
+        else:
+            o_write("void %s::run(std::ostream &out) {\n" % class_name)
 
         # writing into the header
         h_write('#include "hamltemplate.h"\n\n')
@@ -180,26 +362,28 @@ class ClassCppWriter(AbstractCppWriter):
         h_write("\t{name}({para}) ".format(name=class_name, para=para_str))
 
         if paras:
-            cp_str = ', '.join("{0}({0})".format(para.split()[-1])
+            cp_str = ', '.join("{0}({0})".format(para_name(para))
                     for para in paras)
 
             h_write(": " + cp_str)
 
         h_write("{}\n")
         h_write("\tvirtual void run(std::ostream &out);\n")
+
+        if self.string_sink:
+            h_write("\tvoid run(std::string &out);\n")
+
         h_write("\nprivate:\n")
 
+        if self.string_sink:
+            h_write("\ttemplate<class Out> void render(Out &out);\n\n")
+
         for para in paras:
             h_write("\t{para};\n".format(para=para))
 
-        h_write("};\n\n#endif\n")
+        h_write("};\n")
 
-        self.header.close()
-        self.header = None
+        self.end_declare()
 
         self.indent += 1
 
-    def finish(self):
-        self.flush()
-        self.out.write("}\n")
-
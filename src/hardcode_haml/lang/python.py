@@ -20,16 +20,45 @@
 
 from os.path import join
 
+from hardcode_haml import primitives
+from hardcode_haml.output import OutputFile
+
+# default number of bytes written by async templates before awaiting drain()
+DRAIN_THRESHOLD = 1 << 14
+
+# runtime helper for escaped evaluations, chained replace() calls are a lot
+# faster than str.translate() on text with many entities
+escape_helper = "\n\ndef _escape(value):\n    return str(value){calls}\n".format(
+        calls=''.join('.replace(%r, %r)' % item
+            for item in primitives.html_escapes.items()))
+
 class PythonWriter:
 
     NAME = "Python using functions"
     IDS = ['python']
 
-    def __init__(self, name, directory):
-        file_name = join(directory, name + ".py")
-        self.out = open(file_name, 'w')
+    # the templates may be bundled as package with a lazy registry
+    PYTHON_PACKAGE = True
+
+    # hooks for the different ways of returning the output
+    DEF = 'def'
+    SINK_PARAS = ['out']
+    PROLOGUE = ['_write = out.write']
+    EPILOGUE = []
+
+    def __init__(self, name, directory, out=None, opts=None):
+        if out == None:
+            self.out = OutputFile(join(directory, name + ".py"))
+            self.close_out = True
+        else:
+            # writing into a stream owned by the caller
+            self.out = out
+            self.close_out = False
+
         self.write_buf = []
         self.name = name
+        self.opts = opts or {}
+        self.escaping = False
 
     def start(self):
         self.indent = 0
@@ -37,14 +66,39 @@ class PythonWriter:
     def finish(self):
         self.flush()
 
+        for line in self.EPILOGUE:
+            self.execute(line)
+
+        if self.escaping:
+            self.out.write(escape_helper)
+
+        if self.close_out:
+            self.out.close()
+
     def declare(self, paras):
-        para_str = ', '.join(['out'] + paras)
-        fstr = "\ndef {name}({para}):\n"
-        self.out.write(fstr.format(name=self.name, para=para_str))
+        para_str = ', '.join(self.SINK_PARAS + paras)
+        fstr = "\n{define} {name}({para}):\n"
+        self.out.write(fstr.format(define=self.DEF, name=self.name,
+            para=para_str))
         self.indent += 1
 
-    def evaluate(self, cmd):
-        self.execute("out.write(str({cmd}))".format(cmd=cmd))
+        for line in self.PROLOGUE:
+            self.execute(line)
+
+    def evaluate(self, cmd, escape=False):
+        # literals were already folded into static text by the IR
+        if escape:
+            self.escaping = True
+            self.write_buf.append(("_escape({cmd})".format(cmd=cmd),))
+        else:
+            # formatted together with the surrounding text when flushing
+            self.write_buf.append((cmd,))
+
+    def fold_text(self, cmd):
+        return primitives.python_text(cmd)
+
+    def fold_condition(self, expression):
+        return primitives.python_condition(expression)
 
     def execute(self, cmd):
         self.flush()
@@ -56,9 +110,32 @@ class PythonWriter:
 
     def flush(self):
         if self.write_buf:
-            data = ''.join(self.write_buf)
+            pieces = self.write_buf
             self.write_buf = []
-            self.execute('out.write({data})'.format(data=repr(data)))
+
+            cmds = [piece[0] for piece in pieces if isinstance(piece, tuple)]
+
+            if not cmds:
+                data = ''.join(pieces)
+
+                if data:
+                    self.write_static(data)
+
+                return
+
+            # one write for the whole chunk, '%s' converts like str() does
+            fmt = ''.join('%s' if isinstance(piece, tuple)
+                    else piece.replace('%', '%%') for piece in pieces)
+            args = ''.join('({cmd}), '.format(cmd=cmd) for cmd in cmds)
+
+            fstr = '{fmt} % ({args})'
+            self.write_dynamic(fstr.format(fmt=repr(fmt), args=args.rstrip()))
+
+    def write_static(self, data):
+        self.execute('_write({data})'.format(data=repr(data)))
+
+    def write_dynamic(self, expr):
+        self.execute('_write({expr})'.format(expr=expr))
 
     def conditional_block(self, expression):
         self.block_exec("if {expr}".format(expr=expression))
@@ -75,3 +152,49 @@ class PythonWriter:
         self.flush()
         self.out.write("    " * self.indent + "# " + data + "\n")
 
+class PythonStrWriter(PythonWriter):
+    '''Returns the output as a string instead of writing into a stream'''
+
+    NAME = "Python returning a string"
+    IDS = ['python-str']
+
+    SINK_PARAS = []
+    PROLOGUE = ['_parts = []', '_write = _parts.append']
+    EPILOGUE = ["return ''.join(_parts)"]
+
+class PythonAsyncWriter(PythonWriter):
+    '''Generates coroutines writing encoded chunks into an
+    asyncio.StreamWriter like sink. drain() is awaited whenever more than
+    DRAIN_THRESHOLD bytes were written since the last time'''
+
+    NAME = "Python using async functions"
+    IDS = ['python-async']
+
+    DEF = 'async def'
+    PROLOGUE = ['_write = out.write', '_pending = 0']
+    EPILOGUE = ['await out.drain()']
+
+    def start(self):
+        PythonWriter.start(self)
+
+        threshold = self.opts.get('drain_threshold') or DRAIN_THRESHOLD
+        self.out.write("DRAIN_THRESHOLD = {threshold}\n".format(
+            threshold=threshold))
+
+    def write_static(self, data):
+        data = data.encode('utf-8')
+        self.execute('_write({data})'.format(data=repr(data)))
+        self.execute('_pending += {length}'.format(length=len(data)))
+        self.drain()
+
+    def write_dynamic(self, expr):
+        self.execute('_chunk = ({expr}).encode()'.format(expr=expr))
+        self.execute('_write(_chunk)')
+        self.execute('_pending += len(_chunk)')
+        self.drain()
+
+    def drain(self):
+        self.block_exec('if _pending >= DRAIN_THRESHOLD')
+        self.execute('await out.drain()')
+        self.execute('_pending = 0')
+        self.close_block()
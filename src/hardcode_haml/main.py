@@ -19,19 +19,252 @@
 ##
 ###############################################################################
 
+import json
+import py_compile
+import sys
+import time
+from multiprocessing import Pool, cpu_count
 from optparse import OptionParser
-from os.path import split
+from os.path import join, split, splitext
 
-from hardcode_haml.parser import HamlFile
+from hardcode_haml.cache import CompileCache, file_stamp
+from hardcode_haml.deps import collect_dependencies, write_depfile
+from hardcode_haml.names import template_name
+from hardcode_haml.output import collect_outputs
+from hardcode_haml.package import RESERVED, write_package
+from hardcode_haml.pool import collect_segments, write_pool
+from hardcode_haml.profiler import Profiler, format_report, merge_reports
+from hardcode_haml.parser import HamlFile, StreamingHamlFile, ParserException
+from hardcode_haml.unity import write_unity
 
 from hardcode_haml.lang import c, cpp, python
 
+def compile_file(in_file, out_module, directory, opts, profile=False):
+    '''Parse one Haml file and write it using the output module. Returns a
+    tuple of an error message (None on success), the written files, the
+    static segments placed in the string pool, the included partials and the
+    profiling report (None if not profiling)'''
+    if opts.get('stream'):
+        parser_class = StreamingHamlFile
+    else:
+        parser_class = HamlFile
+
+    error = None
+    profiler = Profiler() if profile else None
+    name = template_name(in_file)
+
+    # partials are looked up relative to the template
+    file_opts = dict(opts, path=in_file)
+
+    with collect_outputs() as outputs, collect_segments() as segments, \
+            collect_dependencies() as dependencies:
+        if profiler:
+            restore = profiler.instrument()
+
+        try:
+            with open(in_file, 'r') as inp:
+                parser = parser_class(inp, file_opts)
+
+                writer = out_module(name, directory, opts=opts)
+
+                if profiler:
+                    writer = profiler.wrap_writer(writer)
+
+                parser.execute(writer)
+        except ParserException as e:
+            error = "%s: %s" % (in_file, e)
+        except EnvironmentError as e:
+            error = "%s: %s" % (in_file, e)
+        finally:
+            if profiler:
+                restore()
+
+    if opts.get('depfiles') and not error:
+        targets = [path for path in outputs
+                if splitext(split(path)[1])[0] == name]
+        write_depfile(join(directory, name + ".d"), targets,
+                [in_file] + dependencies)
+
+    report = profiler.report() if profiler else None
+
+    return error, outputs, segments, dependencies, report
+
+def _compile_job(args):
+    '''Unpack the arguments of compile_file() for the process pool'''
+    return compile_file(*args)
+
+def compile_files(in_files, out_module, directory, opts, jobs=1, cache=None,
+        profiles=None, segments=None, dependencies=None):
+    '''Compile all input files which are not up to date according to the
+    cache. Returns a list of error messages. Profiling reports are stored
+    for each compiled file if profiles is a dict, the pooled static segments
+    of each file (compiled or not) if segments is a dict and the included
+    partials of each file if dependencies is a dict'''
+    tasks = []
+    keys = {}
+
+    for in_file in in_files:
+        if cache:
+            key = cache.key(in_file, out_module, directory, opts)
+
+            if cache.is_fresh(in_file, key):
+                if segments != None:
+                    segments[in_file] = cache.segments(in_file)
+
+                if dependencies != None:
+                    dependencies[in_file] = cache.dependencies(in_file)
+
+                continue
+
+            keys[in_file] = key
+
+        tasks.append((in_file, out_module, directory, opts,
+            profiles != None))
+
+    jobs = jobs if jobs > 0 else cpu_count()
+    jobs = min(jobs, len(tasks))
+
+    if jobs > 1:
+        # keep the chunks small enough to balance the load on the workers
+        chunk_size = max(1, len(tasks) // (jobs * 4))
+
+        pool = Pool(jobs)
+
+        try:
+            results = list(pool.imap(_compile_job, tasks, chunk_size))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_compile_job(task) for task in tasks]
+
+    errors = []
+
+    for task, (error, outputs, pooled, partials, report) in zip(tasks,
+            results):
+        in_file = task[0]
+
+        if report != None:
+            profiles[in_file] = report
+
+        if segments != None:
+            segments[in_file] = pooled
+
+        if dependencies != None:
+            dependencies[in_file] = partials
+
+        if error:
+            errors.append(error)
+
+            if cache:
+                cache.discard(in_file)
+        elif cache:
+            cache.update(in_file, keys[in_file], outputs, pooled, partials)
+
+    if cache and tasks:
+        cache.save()
+
+    return errors
+
+def update_pool(directory, segments):
+    '''Write the string pool of all templates and return a short report'''
+    inlined, size = write_pool(directory, list(segments.values()))
+
+    rstr = "String pool: %i bytes instead of %i bytes inlined (%i bytes saved)"
+    return rstr % (size, inlined, inlined - size)
+
+def update_package(directory, in_files):
+    '''Write the registry and bytecode of a template package, returns an
+    error message or None'''
+    try:
+        write_package(directory, [template_name(in_file)
+            for in_file in in_files])
+    except py_compile.PyCompileError as e:
+        return e.msg
+
+def watch(in_files, out_module, directory, opts, interval, cache=None,
+        segments=None, dependencies=None, package=False):
+    '''Poll the input files and the partials they include (dependencies maps
+    each input file to those) and recompile them as soon as they change.
+    Runs until interrupted. The string pool is updated if segments is a
+    dict, the package if package is set'''
+    if dependencies == None:
+        dependencies = {}
+
+    def watched():
+        paths = set(in_files)
+
+        for partials in dependencies.values():
+            paths.update(partials)
+
+        return paths
+
+    stamps = dict((path, file_stamp(path)) for path in watched())
+
+    print("Watching %i files for changes" % len(in_files))
+
+    try:
+        while True:
+            time.sleep(interval)
+
+            touched = set()
+
+            for path in watched():
+                stamp = file_stamp(path)
+
+                if stamp != stamps.get(path):
+                    stamps[path] = stamp
+
+                    # ignore files while they are deleted or replaced
+                    if stamp != None:
+                        touched.add(path)
+
+            changed = [in_file for in_file in in_files if in_file in touched
+                    or touched.intersection(dependencies.get(in_file, ()))]
+
+            if not changed:
+                continue
+
+            start = time.time()
+
+            errors = compile_files(changed, out_module, directory, opts,
+                    cache=cache, segments=segments,
+                    dependencies=dependencies)
+
+            # partials included for the first time are watched from now on
+            for path in watched():
+                if path not in stamps:
+                    stamps[path] = file_stamp(path)
+
+            if segments != None:
+                update_pool(directory, segments)
+
+            if package:
+                error = update_package(directory, in_files)
+
+                if error:
+                    errors.append(error)
+
+            for error in errors:
+                sys.stderr.write(error + "\n")
+
+            elapsed = (time.time() - start) * 1000
+            print("Compiled %s (%.1f ms)" % (', '.join(changed), elapsed))
+            sys.stdout.flush()
+    except KeyboardInterrupt:
+        return 0
+
 def main():
     out_modules = [
             cpp.ClassCppWriter,
             cpp.FunCppWriter,
             c.CWriter,
+            c.CCallbackWriter,
+            c.CBufferWriter,
+            c.CIovecWriter,
             python.PythonWriter,
+            python.PythonStrWriter,
+            python.PythonAsyncWriter,
             ]
 
     optp = OptionParser(usage="usage: %prog [options] file [...]")
@@ -53,7 +286,77 @@ def main():
     optp.add_option("-l", "--list",
             help="List available output modules",
             action="store_true")
-    
+
+    optp.add_option("-j", "--jobs",
+            help="Compile N files in parallel (0 uses all CPUs)",
+            metavar="N",
+            type="int",
+            default=1)
+
+    optp.add_option("-c", "--cache",
+            help="Skip unchanged templates using the cache in FILE",
+            metavar="FILE")
+
+    optp.add_option("-e", "--escape-html",
+            help="Escape the output of all evaluations (use != to disable)",
+            action="store_true")
+
+    optp.add_option("-s", "--stream",
+            help="Write output while parsing to keep memory usage low",
+            action="store_true")
+
+    optp.add_option("-m", "--minify",
+            help="Leave out indentation and line breaks between tags",
+            action="store_true")
+
+    optp.add_option("--string-sink",
+            help="Let C++ templates also write into std::string",
+            action="store_true")
+
+    optp.add_option("--drain-threshold",
+            help="Let async Python templates await drain() after BYTES",
+            metavar="BYTES",
+            type="int")
+
+    optp.add_option("--pool",
+            help="Share static text of all templates in one string pool "
+                "(C and C++, compile all templates at once)",
+            action="store_true")
+
+    optp.add_option("--unity",
+            help="Include the C++ sources of all templates in N unity files "
+                "with one header",
+            metavar="N",
+            type="int")
+
+    optp.add_option("-M", "--depfiles",
+            help="Write a make/ninja depfile NAME.d listing the included "
+                "partials of each template",
+            action="store_true")
+
+    optp.add_option("--package",
+            help="Make the output directory a Python package importing "
+                "templates on first use, with precompiled bytecode",
+            action="store_true")
+
+    optp.add_option("-w", "--watch",
+            help="Keep running and recompile files when they change",
+            action="store_true")
+
+    optp.add_option("--interval",
+            help="Poll for changes every SECONDS in watch mode",
+            metavar="SECONDS",
+            type="float",
+            default=0.025)
+
+    optp.add_option("-p", "--profile",
+            help="Print time and allocations of each phase and element",
+            action="store_true")
+
+    optp.add_option("--profile-json",
+            help="Write the profiling report of the whole run to FILE",
+            metavar="FILE")
+
     (options, args) = optp.parse_args()
 
     if options.list:
@@ -79,28 +382,100 @@ def main():
             print("Output module '%s' not found" % options.output)
             return 2
 
+        if options.pool and not getattr(out_module, 'STRING_POOL', False):
+            print("Output module '%s' can't use a string pool" % options.output)
+            return 2
+
+        if options.unity != None:
+            if not getattr(out_module, 'UNITY_BUILD', False):
+                print("Output module '%s' can't do unity builds" % options.output)
+                return 2
+
+            if options.unity < 1:
+                print("At least one unity file is needed")
+                return 2
+
+        if options.package:
+            if not getattr(out_module, 'PYTHON_PACKAGE', False):
+                print("Output module '%s' can't build packages" % options.output)
+                return 2
+
+            for in_file in args:
+                if template_name(in_file) in RESERVED:
+                    print("Template name '%s' is used by the package"
+                            % template_name(in_file))
+                    return 2
+
         opts = {
-                'indent': True,
+                'indent': not options.minify,
+                'minify': options.minify,
                 'debug': options.readable,
                 'auto_indent': True,
+                'stream': options.stream,
+                'escape_html': options.escape_html,
+                'string_sink': options.string_sink,
+                'pool': options.pool,
+                'drain_threshold': options.drain_threshold,
+                'depfiles': options.depfiles,
                 }
 
-        for in_file in args:
-            file_name = split(in_file)[1]
+        cache = CompileCache(options.cache) if options.cache else None
+
+        profile = options.profile or options.profile_json
+        profiles = {} if profile else None
+
+        segments = {} if options.pool else None
 
-            # determine template name
-            if file_name.lower().endswith(".haml"):
-                # the sane way
-                name = file_name[:-5]
-            else:
-                # backup solution
-                name = file_name.split('.')[0]
+        dependencies = {}
 
-            parser = HamlFile(open(in_file, 'r'), opts)
-            writer = out_module(name, options.directory)
+        errors = compile_files(args, out_module, options.directory, opts,
+                options.jobs, cache, profiles, segments, dependencies)
 
-            parser.execute(writer)
+        for error in errors:
+            sys.stderr.write(error + "\n")
+
+        if options.pool:
+            print(update_pool(options.directory, segments))
+
+        if options.unity:
+            names = [template_name(in_file) for in_file in args]
+            write_unity(options.directory, names, options.unity)
+
+        if options.package:
+            error = update_package(options.directory, args)
+
+            if error:
+                errors.append(error)
+                sys.stderr.write(error + "\n")
+
+        if profile:
+            for in_file in args:
+                if in_file in profiles:
+                    print(format_report(in_file, profiles[in_file]))
+
+            total = merge_reports(profiles.values())
+
+            print(format_report("total", total))
+
+            if options.profile_json:
+                data = {
+                        'files': profiles,
+                        'total': total,
+                        }
+
+                with open(options.profile_json, 'w') as out:
+                    json.dump(data, out, indent=2, sort_keys=True)
+
+        if options.watch:
+            return watch(args, out_module, options.directory, opts,
+                    options.interval, cache, segments, dependencies,
+                    options.package)
+
+        if errors:
+            return 3
+
+        return 0
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
 
@@ -0,0 +1,134 @@
+###############################################################################
+##
+##  hardcode_haml - Haml for hardcore coders
+##  Copyright (C) 2010  Thammi
+## 
+##  This program is free software: you can redistribute it and/or modify
+##  it under the terms of the GNU Affero General Public License as published by
+##  the Free Software Foundation, either version 3 of the License, or
+##  (at your option) any later version.
+## 
+##  This program is distributed in the hope that it will be useful,
+##  but WITHOUT ANY WARRANTY; without even the implied warranty of
+##  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##  GNU Affero General Public License for more details.
+## 
+##  You should have received a copy of the GNU Affero General Public License
+##  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+###############################################################################
+
+import io
+import os
+from contextlib import contextmanager
+
+_recorders = []
+
+@contextmanager
+def collect_outputs():
+    '''Context manager yielding a list which collects the paths of all
+    OutputFile instances created inside of it. Files which were not closed
+    when leaving the context are incomplete and get discarded'''
+    files = []
+    paths = []
+    _recorders.append(files)
+
+    try:
+        yield paths
+    finally:
+        _recorders.remove(files)
+
+        for output in files:
+            if output.closed():
+                paths.append(output.path)
+            else:
+                output.discard()
+
+def open_tmp(path):
+    '''Open a temporary file next to path for writing binary data'''
+    tmp_path = "%s.%i.tmp" % (path, os.getpid())
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+    return tmp_path, os.fdopen(fd, 'wb')
+
+def same_content(path_a, path_b, chunk_size=1 << 16):
+    '''Compare the content of two files without loading them at once'''
+    if os.path.getsize(path_a) != os.path.getsize(path_b):
+        return False
+
+    with open(path_a, 'rb') as a, open(path_b, 'rb') as b:
+        while True:
+            chunk = a.read(chunk_size)
+
+            if chunk != b.read(chunk_size):
+                return False
+
+            if not chunk:
+                return True
+
+def commit_tmp(tmp_path, path):
+    '''Move the temporary file over path if the content differs, otherwise
+    remove it. Returns True if path was replaced'''
+    if os.path.exists(path) and same_content(tmp_path, path):
+        os.remove(tmp_path)
+        return False
+    else:
+        os.replace(tmp_path, path)
+        return True
+
+def replace_file(path, data):
+    '''Atomically replace the content of path with data (bytes) unless it is
+    already up to date. Returns True if the file was written'''
+    tmp_path, tmp = open_tmp(path)
+
+    with tmp:
+        tmp.write(data)
+
+    return commit_tmp(tmp_path, path)
+
+class OutputFile:
+    '''File-like object writing into a temporary file. The target file is
+    only replaced (atomically) on close() if its content actually changed,
+    which keeps the modification time of unchanged files intact'''
+
+    def __init__(self, path, encoding='utf-8'):
+        self.path = path
+        self.changed = None
+
+        self.tmp_path, tmp = open_tmp(path)
+        self.out = io.TextIOWrapper(tmp, encoding=encoding)
+
+        for files in _recorders:
+            files.append(self)
+
+    def write(self, data):
+        self.out.write(data)
+
+    def closed(self):
+        return self.out == None
+
+    def close(self):
+        if self.out == None:
+            return
+
+        self.out.close()
+        self.out = None
+
+        self.changed = commit_tmp(self.tmp_path, self.path)
+
+    def discard(self):
+        '''Drop the output without touching the target file'''
+        if self.out == None:
+            return
+
+        self.out.close()
+        self.out = None
+
+        os.remove(self.tmp_path)
+
+def write_shared(directory, name, content):
+    '''Writes a file shared by several templates (like a header with
+    helpers). Like other outputs it is only replaced if it changed, so
+    headers written by older versions are updated'''
+    out = OutputFile(os.path.join(directory, name))
+    out.write(content)
+    out.close()
@@ -0,0 +1,111 @@
+###############################################################################
+##
+##  hardcode_haml - Haml for hardcore coders
+##  Copyright (C) 2010  Thammi
+## 
+##  This program is free software: you can redistribute it and/or modify
+##  it under the terms of the GNU Affero General Public License as published by
+##  the Free Software Foundation, either version 3 of the License, or
+##  (at your option) any later version.
+## 
+##  This program is distributed in the hope that it will be useful,
+##  but WITHOUT ANY WARRANTY; without even the implied warranty of
+##  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##  GNU Affero General Public License for more details.
+## 
+##  You should have received a copy of the GNU Affero General Public License
+##  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+###############################################################################
+
+import importlib.util
+import os
+import py_compile
+from os.path import join
+
+from hardcode_haml.output import replace_file
+
+# names defined by the registry, templates can't use those
+RESERVED = frozenset(['get', 'names', 'importlib'])
+
+registry = """\
+'''Templates compiled by hardcode_haml. Each one is imported on first use
+through get(name) or as attribute of this package'''
+
+import importlib
+
+names = frozenset([
+{names}
+])
+
+_templates = {{}}
+
+def get(name):
+    '''Returns the template function called name'''
+    try:
+        return _templates[name]
+    except KeyError:
+        pass
+
+    if name not in names:
+        raise KeyError(name)
+
+    template = getattr(importlib.import_module('.' + name, __name__), name)
+    _templates[name] = template
+
+    # the import bound the module, following attribute lookups get the
+    # template directly
+    globals()[name] = template
+
+    return template
+
+def __getattr__(name):
+    if name in names:
+        return get(name)
+
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+def __dir__():
+    return sorted(set(globals()) | names)
+"""
+
+def compile_bytecode(path):
+    '''Writes the bytecode of a Python file into __pycache__ unless it is up
+    to date. The source hash is checked on import, so the bytecode stays
+    valid when deployments reset modification times'''
+    cfile = importlib.util.cache_from_source(path)
+
+    with open(path, 'rb') as inp:
+        source_hash = importlib.util.source_hash(inp.read())
+
+    try:
+        with open(cfile, 'rb') as inp:
+            header = inp.read(16)
+    except EnvironmentError:
+        header = None
+
+    # magic, flags (hash based and checked) and the hash of the source
+    expected = importlib.util.MAGIC_NUMBER + b'\x03\x00\x00\x00' + source_hash
+
+    if header != expected:
+        py_compile.compile(path, cfile, doraise=True,
+                invalidation_mode=py_compile.PycInvalidationMode.CHECKED_HASH)
+
+def write_package(directory, names):
+    '''Makes the directory a package with a lazy registry of the templates
+    and precompiles the bytecode of all of them'''
+    names = sorted(set(names))
+
+    init = registry.format(names='\n'.join("    '%s'," % name
+        for name in names))
+
+    init_path = join(directory, "__init__.py")
+    replace_file(init_path, init.encode('utf-8'))
+
+    for name in names:
+        path = join(directory, name + ".py")
+
+        if os.path.exists(path):
+            compile_bytecode(path)
+
+    compile_bytecode(init_path)
@@ -18,7 +18,25 @@
 ##
 ###############################################################################
 
+import os
 import re
+import sys
+from types import MappingProxyType
+
+from hardcode_haml.deps import depends
+from hardcode_haml.ir import IRBuilder
+from hardcode_haml.primitives import escape_html
+from hardcode_haml.scanner import Scanner
+
+word_re = re.compile(r'\w+')
+space_re = re.compile(r'\s*')
+non_space_re = re.compile(r'\S')
+separator_re = re.compile(r'\s*,?')
+html_assign_re = re.compile(r'\??=')
+hash_assign_re = re.compile(r'\??=>')
+
+# plain characters inside of attribute values for each set of stoppers
+value_res = {}
 
 auto_closing_tags = [
         'meta',
@@ -33,45 +51,19 @@ auto_closing_tags = [
         'base',
         ]
 
-def is_escaped(value, index):
-    '''Returns True if the character at index is escaped with a \ '''
-    cur = index - 1
-
-    if cur < 0:
-        return False
-
-    # loop while on a backshlash
-    while value[cur] == '\\':
-        cur -= 1
-
-        # the end is neigh, let's stop
-        if cur < 0:
-            break
-
-    # uneven number of backslashs?
-    return (index - cur - 1) % 2
+# tags whose content keeps its whitespace when minifying
+preserving_tags = [
+        'pre',
+        'textarea',
+        'script',
+        'style',
+        ]
 
 def find_unescaped(haystack, needle, start=0):
     '''Returns the index of the first unescaped appearance of needle in
     haystack or -1'''
 
-    last = start
-
-    while True:
-        index = haystack.find(needle, last)
-
-        # nothing found
-        if index == -1:
-            break
-
-        if is_escaped(haystack, index):
-            # the needle escaped, let's go on
-            last = index + 1
-        else:
-            # we found the needle
-            return index
-
-    return -1
+    return Scanner(haystack, start).find_unescaped(needle)
 
 class ParserException(Exception):
     '''An exception which occured during parsing at a specific line'''
@@ -81,15 +73,26 @@ class ParserException(Exception):
         self.line = line
 
     def __str__(self):
-        return "[at line %i] %s" % (self.line, self.msg)
+        if self.line == None:
+            return self.msg
+        else:
+            return "[at line %i] %s" % (self.line, self.msg)
+
+# shared by all elements without sub-block
+no_childs = ()
+
+# shared by all tags without attributes
+no_attrs = MappingProxyType({})
 
 class HamlElement:
     '''A syntax element in a haml tree'''
 
+    __slots__ = ('opts', 'line', 'childs')
+
     def __init__(self, data, opts, line=None):
         self.opts = opts
         self.line = line
-        self.childs = []
+        self.childs = no_childs
 
         self.parse(data)
 
@@ -97,9 +100,19 @@ class HamlElement:
         '''Raise a ParserException with the current line number'''
         raise ParserException(msg, self.line)
 
+    def check_child(self, child):
+        '''Raise a ParserException if child can't be added to this
+        element'''
+        pass
+
     def add_child(self, child):
         '''Append an element to this sub-tree'''
-        self.childs.append(child)
+        self.check_child(child)
+
+        if self.childs:
+            self.childs.append(child)
+        else:
+            self.childs = [child]
 
     def option(self, key):
         '''Returns the value of the otion or None'''
@@ -115,6 +128,11 @@ class HamlElement:
         if self.option('indent'):
             out.write(" " * (indent * 2))
 
+    def write_newline(self, out):
+        '''Write a line break unless the output is minified'''
+        if not self.option('minify'):
+            out.write("\n")
+
     def exec_childs(self, out, indent):
         '''Call execute() on all child elements'''
         for child in self.childs:
@@ -130,14 +148,38 @@ class HamlElement:
         '''Overwrite this to parse the Haml input'''
         raise NotImplementedError
 
+    def block_indent(self, indent):
+        '''Returns the indent of the sub-block or None if it should not be
+        executed'''
+        return indent + 1
+
+    def execute_open(self, out, indent, has_childs):
+        '''Write the output in front of the sub-block'''
+        raise NotImplementedError
+
+    def execute_close(self, out, indent, has_childs):
+        '''Write the output after the sub-block'''
+        raise NotImplementedError
+
     def execute(self, out, indent):
         '''Write output to out according previously parsed input'''
-        raise NotImplementedError
+        has_childs = bool(self.childs)
+
+        self.execute_open(out, indent, has_childs)
+
+        child_indent = self.block_indent(indent)
+
+        if has_childs and child_indent != None:
+            self.exec_childs(out, child_indent)
+
+        self.execute_close(out, indent, has_childs)
 
 class ChildlessElement(HamlElement):
     '''A Haml element throwing an exception when attempting to add childs'''
 
-    def add_child(self, child):
+    __slots__ = ()
+
+    def check_child(self, child):
         self.fail("This element can't contain sub-blocks")
 
 class MultilineStack:
@@ -173,61 +215,135 @@ def split_lines(inp):
     multi_stack = MultilineStack()
 
     for num, line in enumerate(inp, 1):
-        if line.strip():
-            multi = re.match("^(.*)\s+\|\s*$", line)
+        stripped = line.rstrip()
 
-            if multi:
-                multi_stack.push(num, multi.group(1))
+        if stripped:
+            # multiline lines end with a '|' separated by whitespace
+            if stripped[-1] == '|' and stripped[-2:-1].isspace():
+                multi_stack.push(num, stripped[:-1])
             else:
                 if multi_stack.loaded():
                     yield multi_stack.dump()
 
                 yield num, line
 
+class WhitespaceStripper:
+    '''Proxy in front of the output module which holds back trailing
+    whitespace of the static output so the whitespace removal of tags can
+    drop it. Dynamic output and blocks release the whitespace first'''
+
+    def __init__(self, out):
+        self.out = out
+        self.pending = ""
+        self.skipping = False
+
+    def strip_whitespace(self, following=False):
+        '''Drop the whitespace written so far, also the whitespace at the
+        start of the following static output if requested'''
+        self.pending = ""
+
+        if following:
+            self.skipping = True
+
+    def release(self):
+        '''Pass the held back whitespace on'''
+        self.skipping = False
+
+        if self.pending:
+            self.out.write(self.pending)
+            self.pending = ""
+
+    def write(self, data):
+        if self.skipping:
+            data = data.lstrip()
+
+            if not data:
+                return
+
+            self.skipping = False
+
+        content = data.rstrip()
+
+        if content:
+            self.out.write(self.pending + content)
+            self.pending = data[len(content):]
+        else:
+            self.pending += data
+
+    def start(self):
+        self.out.start()
+
+    def declare(self, paras):
+        self.release()
+        self.out.declare(paras)
+
+    def evaluate(self, cmd, escape=False):
+        self.release()
+        self.out.evaluate(cmd, escape)
+
+    def execute(self, cmd):
+        self.release()
+        self.out.execute(cmd)
+
+    def flush(self):
+        self.release()
+        self.out.flush()
+
+    def conditional_block(self, expression):
+        self.release()
+        self.out.conditional_block(expression)
+
+    def block_exec(self, cmd):
+        self.release()
+        self.out.block_exec(cmd)
+
+    def close_block(self):
+        self.release()
+        self.out.close_block()
+
+    def comment(self, data):
+        self.out.comment(data)
+
+    def finish(self):
+        self.release()
+        self.out.finish()
+
 class HamlFile(HamlElement):
     '''Root Haml element parsing the whole file'''
 
+    __slots__ = ('indent_str', 'manual_declare')
+
     def count_indent(self, line):
         '''Count the number of indents according to options (might use auto
         indent)'''
 
-        if self.indent_str == None:
-            indent = re.match("^\s*", line).group()
+        indent = line[:len(line) - len(line.lstrip())]
 
-            if indent:
-                self.indent_str = indent
-            else:
-                return 0
+        if not indent:
+            return 0
 
-        count = 0
-        cur = line
-        indent_len = len(self.indent_str)
-        while cur.startswith(self.indent_str):
-            count += 1
-            cur = cur[indent_len:]
+        if self.indent_str == None:
+            self.indent_str = indent
 
-        if cur[0].isspace():
+        count = len(indent) // len(self.indent_str)
+
+        if indent != self.indent_str * count:
             return -1
 
         return count
 
-    def parse(self, inp):
-        '''Parse the input file'''
-        self.manual_declare = False
-        stack = [self]
-
+    def parse_lines(self, inp):
+        '''Generator yielding the indent and the parsed element of each
+        line'''
         self.indent_str = None if self.option('auto_indent') else "  "
 
-        actions = {
-                '#\w+': XmlTag,
-                '%\w+': XmlTag,
-                '\.\w+': XmlTag,
-                '-': Execution,
-                '/': Comment,
-                '\\\\': Escape,
-                '\?': Declaration,
-                '!!!': Doctype,
-                }
+        declared = False
+        depth = 1
+
+        # whitespace-sensitive tags are rendered unminified
+        opts = self.opts
+        preserve_opts = dict(opts, indent=True, minify=False)
+        preserved = None
 
         for line, data in split_lines(inp):
             indent = self.count_indent(data)
@@ -235,50 +351,168 @@ class HamlFile(HamlElement):
             if indent == -1:
                 raise ParserException("Could not parse indent", line)
 
-            if indent >= len(stack):
+            if indent >= depth:
                 raise ParserException("More than one indent added", line)
 
-            stack = stack[:indent+1]
+            depth = indent + 2
 
             content = data.strip()
 
-            for pattern, pos_action in list(actions.items()):
-                if re.match(pattern, content):
-                    action = pos_action
-                    break
-            else:
-                action = DirectDisplay
+            action = classify_line(content)
 
             # TODO: still kind of hacky
             if content.startswith('?'):
-                if self.manual_declare:
-                    self.fail("Multiple declarations")
-                elif len(stack) > 1:
-                    self.fail("Declaration inide a block")
+                if declared:
+                    raise ParserException("Multiple declarations", line)
+                elif indent > 0:
+                    raise ParserException("Declaration inide a block", line)
                 else:
+                    declared = True
                     self.manual_declare = True
 
-            element = action(content, self.opts, line)
+            if preserved != None and indent <= preserved:
+                opts = self.opts
+                preserved = None
+
+            element = action(content, opts, line)
+
+            if (preserved == None and self.option('minify')
+                    and isinstance(element, XmlTag)
+                    and element.name in preserving_tags):
+                opts = preserve_opts
+                preserved = indent
+
+            yield indent, element
+
+    def parse(self, inp):
+        '''Parse the input file'''
+        self.manual_declare = False
+        stack = [self]
+
+        for indent, element in self.parse_lines(inp):
+            del stack[indent+1:]
 
             stack[-1].add_child(element)
             stack.append(element)
 
-    def execute(self, out, indent=0):
-        '''Output the Haml file into the given output module'''
+    def block_indent(self, indent):
+        return indent
 
+    def execute_open(self, out, indent, has_childs):
         out.start()
 
         if not self.manual_declare:
             out.comment("Declaring automatically, no '?' found")
             out.declare([])
 
-        self.exec_childs(out, indent)
-
+    def execute_close(self, out, indent, has_childs):
         out.finish()
 
+    def execute(self, out, indent=0):
+        '''Output the Haml file into the given output module'''
+        out = WhitespaceStripper(IRBuilder(out))
+        HamlElement.execute(self, out, indent)
+
+class Partial(HamlFile):
+    '''Root element of an included Haml file, only its content is written
+    into the including template'''
+
+    __slots__ = ()
+
+    def parse(self, inp):
+        HamlFile.parse(self, inp)
+
+        for child in self.childs:
+            if isinstance(child, Declaration):
+                child.fail("Partials can't declare parameters")
+
+class StreamingHamlFile(HamlFile):
+    '''Root Haml element writing the output while parsing the input. Only
+    the currently open blocks are kept in memory, output is identical to
+    HamlFile'''
+
+    __slots__ = ('inp',)
+
+    def parse(self, inp):
+        '''Prepare streaming the input file'''
+        if not hasattr(inp, 'seekable') or not inp.seekable():
+            inp = list(inp)
+
+        # the implicit declaration has to be written before anything else,
+        # look at the joined lines like parse_lines() does
+        self.manual_declare = False
+
+        for line, data in split_lines(inp):
+            if data.lstrip().startswith('?'):
+                self.manual_declare = True
+                break
+
+        if isinstance(inp, list):
+            self.inp = inp
+        else:
+            inp.seek(0)
+            self.inp = inp
+
+    def execute(self, out, indent=0):
+        '''Parse the input and write the output of each block as soon as
+        its indent closes'''
+        debug = self.option('debug')
+        out = WhitespaceStripper(IRBuilder(out))
+
+        # open blocks: [element, indent, opened, skipped]
+        stack = [[self, indent, True, False]]
+
+        def close_block():
+            element, indent, opened, skipped = stack.pop()
+
+            if skipped:
+                return
+
+            if opened:
+                element.execute_close(out, indent, True)
+            else:
+                element.execute(out, indent)
+
+            if debug and element.line != None:
+                out.comment("<< haml line %i ended" % element.line)
+
+        self.execute_open(out, indent, True)
+
+        for level, element in self.parse_lines(self.inp):
+            while len(stack) > level + 1:
+                close_block()
+
+            parent = stack[-1]
+            parent_element, parent_indent, opened, skipped = parent
+
+            parent_element.check_child(element)
+
+            if not skipped and not opened:
+                parent_element.execute_open(out, parent_indent, True)
+                parent[2] = True
+
+            if not skipped:
+                child_indent = parent_element.block_indent(parent_indent)
+
+            if skipped or child_indent == None:
+                stack.append([element, None, False, True])
+                continue
+
+            if debug and element.line != None:
+                out.comment(">> haml line %i started" % element.line)
+
+            stack.append([element, child_indent, False, False])
+
+        while len(stack) > 1:
+            close_block()
+
+        self.execute_close(out, indent, True)
+
 class Declaration(ChildlessElement):
     '''Element which declares the parameters of the template'''
 
+    __slots__ = ('paras',)
+
     def parse(self, data):
         payload = data[1:]
 
@@ -290,36 +524,83 @@ class Declaration(ChildlessElement):
     def execute(self, out, indent):
         out.declare(self.paras)
 
+class Include(ChildlessElement):
+    '''Element inlining a partial (another Haml file) at compile time. The
+    path is relative to the including file, '.haml' may be left out'''
+
+    __slots__ = ('partial',)
+
+    def parse(self, data):
+        name = data[1:].strip()
+
+        if not name:
+            self.fail("No partial given")
+
+        if not name.lower().endswith(".haml"):
+            name += ".haml"
+
+        base = self.option('path')
+
+        if base:
+            path = os.path.normpath(os.path.join(os.path.dirname(base), name))
+        else:
+            path = os.path.normpath(name)
+
+        chain = self.option('includes') or (base,)
+
+        if path in chain:
+            self.fail("Partial %s includes itself" % path)
+
+        depends(path)
+
+        opts = dict(self.opts, path=path, includes=chain + (path,))
+
+        try:
+            with open(path, 'r') as inp:
+                self.partial = Partial(inp, opts)
+        except EnvironmentError as e:
+            self.fail("Could not read partial %s: %s" % (path, e.strerror))
+        except ParserException as e:
+            self.fail("In partial %s: %s" % (path, e))
+
+    def execute(self, out, indent):
+        self.partial.exec_childs(out, indent)
+
 class Comment(HamlElement):
     '''Element representing a HTML comment'''
 
+    __slots__ = ('comment',)
+
     def parse(self, data):
         self.comment = data[1:].strip()
 
-    def execute(self, out, indent):
+    def execute_open(self, out, indent, has_childs):
         self.write_indent(indent, out)
         out.write("<!--")
 
-        if self.childs:
+        if has_childs:
             if self.comment:
                 self.fail("No content allowed for nested comments")
 
-            out.write("\n")
-
-            self.exec_childs(out, indent + 1)
-
-            self.write_indent(indent, out)
+            self.write_newline(out)
         else:
             out.write(" ")
             out.write(self.comment)
             out.write(" ")
 
-        out.write("-->\n")
+    def execute_close(self, out, indent, has_childs):
+        if has_childs:
+            self.write_indent(indent, out)
+
+        out.write("-->")
+        self.write_newline(out)
 
 class Execution(HamlElement):
     '''Element representing a command or block command in the target
     language'''
 
+    __slots__ = ('comment', 'text', 'command')
+
     def parse(self, data):
         if data[1] == '#':
             # Haml comment
@@ -330,160 +611,205 @@ class Execution(HamlElement):
             self.comment = False
             self.command = data[1:].strip()
 
-    def execute(self, out, indent):
+    def block_indent(self, indent):
+        if self.comment:
+            # the sub-block of a Haml comment is silenced
+            return None
+        else:
+            return indent
+
+    def execute_open(self, out, indent, has_childs):
         if self.comment:
             if self.option('debug'):
                 out.comment(self.text)
-        elif self.childs:
+        elif has_childs:
             out.block_exec(self.command)
-
-            self.exec_childs(out, indent)
-
-            out.close_block()
         else:
             out.execute(self.command)
 
+    def execute_close(self, out, indent, has_childs):
+        if has_childs and not self.comment:
+            out.close_block()
+
 class XmlTag(HamlElement):
     '''Element representing an XML tag'''
 
+    __slots__ = ('attrs', 'booleans', 'name', 'content', 'auto_close',
+            'strip_inner', 'strip_outer')
+
     def parse(self, data):
-        self.attrs = {}
-        self.booleans = {}
+        self.attrs = no_attrs
+        self.booleans = no_attrs
         self.name = 'div'
         self.content = None
 
-        self.data = data
+        scan = Scanner(data)
 
-        self.parse_name()
-        self.parse_attrs()
-        self.parse_modifiers()
-        self.parse_content()
+        self.parse_name(scan)
+        self.parse_attrs(scan)
+        self.parse_modifiers(scan)
+        self.parse_content(scan)
 
     def add_attr(self, key, value, boolean=False):
+        # attribute names and values repeat a lot across templates
+        key = sys.intern(key)
+        value = sys.intern(value)
+
         if boolean:
+            if not self.booleans:
+                self.booleans = {}
+
             self.booleans[key] = value
         else:
+            if not self.attrs:
+                self.attrs = {}
+
             attrs = self.attrs
 
             if key in attrs:
-                attrs[key].append(value)
+                attrs[key] += (value,)
             else:
-                attrs[key] = [value]
+                attrs[key] = (value,)
 
-    def consume_regex(self, regex):
-        match = re.match(regex, self.data)
+    def consume_value(self, scan, stoppers):
+        start = scan.pos
 
-        if match:
-            res = match.group()
-            self.data = self.data[len(res):]
-            return res
-        else:
-            return ""
+        plain_re = value_res.get(stoppers)
 
-    def consume_value(self, stoppers):
-        data = self.data
-        index = 0
+        if plain_re is None:
+            plain_re = re.compile('[^"\'()%s]+' % re.escape(stoppers))
+            value_res[stoppers] = plain_re
 
         bracket_depth = 0
 
         while True:
-            if data[index] in stoppers:
+            if scan.at_end():
+                self.fail("Error parsing value")
+
+            char = scan.peek()
+
+            if char in stoppers:
                 if bracket_depth == 0:
                     break
 
-            if data[index] == '"':
-                index = find_unescaped(data, '"', index + 1) + 1
-            elif data[index] == "'":
-                index = find_unescaped(data, "'", index + 1) + 1
-            elif data[index] == '(':
+            if char == '"' or char == "'":
+                scan.advance()
+                index = scan.find_unescaped(char)
+
+                if index == -1:
+                    self.fail("Error parsing value")
+
+                scan.pos = index + 1
+            elif char == '(':
                 bracket_depth += 1
-                index += 1
-            elif data[index] == ')':
+                scan.advance()
+            elif char == ')':
                 bracket_depth -= 1
-                index += 1
-            else:
-                index += 1
+                scan.advance()
+            elif not scan.consume(plain_re):
+                scan.advance()
 
             if bracket_depth < 0:
                 self.fail("Unmatched closing bracket")
 
-            if not 0 <= index < len(data):
-                self.fail("Error parsing value")
-
-        self.data = data[index:]
-        return data[:index]
+        return scan.slice(start)
 
-    def parse_name_part(self):
-        return self.consume_regex('\w+')
-
-    def parse_name(self):
-        while self.data and self.data[0] not in [' ', '(', '{']:
-            type_c = self.data[0]
-            self.data = self.data[1:]
+    def parse_name(self, scan):
+        while not scan.at_end() and scan.peek() not in ' ({/<>':
+            type_c = scan.peek()
+            scan.advance()
 
             if type_c == '%':
-                self.name = self.parse_name_part()
+                self.name = scan.consume(word_re)
             elif type_c == '#':
-                self.add_attr('"id"', '"%s"' % self.parse_name_part())
+                self.add_attr('"id"', '"%s"' % scan.consume(word_re))
             elif type_c == '.':
-                self.add_attr('"class"', '"%s"' % self.parse_name_part())
+                self.add_attr('"class"', '"%s"' % scan.consume(word_re))
             else:
                 self.fail("Couldn't parse tag name")
 
-    def parse_attrs(self):
-        while self.data and self.data[0] in ['(', '{']:
-            if self.data and self.data[0] == '(':
-                self.data = self.data[1:]
+    def parse_attrs(self, scan):
+        while scan.peek() in ('(', '{'):
+            if scan.peek() == '(':
+                scan.advance()
+
+                while scan.peek() != ')':
+                    if scan.at_end():
+                        self.fail("Failed to parse the attributes")
 
-                while self.data[0] != ')':
-                    self.consume_regex("\s*")
-                    key = '"%s"' % self.consume_regex("\w+")
-                    self.consume_regex("\s*")
-                    operator = self.consume_regex("\??=")
-                    self.consume_regex("\s*")
-                    value = self.consume_value([' ', ')'])
+                    scan.consume(space_re)
+                    key = '"%s"' % scan.consume(word_re)
+                    scan.consume(space_re)
+                    operator = scan.consume(html_assign_re)
+                    scan.consume(space_re)
+                    value = self.consume_value(scan, ' )')
 
                     if value and key:
                         self.add_attr(key, value, operator == "?=")
                     else:
                         self.fail("Failed to parse the attributes")
 
-                self.data = self.data[1:]
+                scan.advance()
 
-            elif self.data and self.data[0] == '{':
-                self.data = self.data[1:]
+            elif scan.peek() == '{':
+                scan.advance()
 
-                while self.data[0] != '}':
-                    self.consume_regex("\s*")
-                    key = self.consume_value(['='])
-                    self.consume_regex("\s*")
-                    operator = self.consume_regex("\??=>")
-                    self.consume_regex("\s*")
-                    value = self.consume_value([',', '}'])
-                    self.consume_regex("\s*,?")
+                while scan.peek() != '}':
+                    if scan.at_end():
+                        self.fail("Failed to parse the attribute")
+
+                    scan.consume(space_re)
+                    key = self.consume_value(scan, '=')
+                    scan.consume(space_re)
+                    operator = scan.consume(hash_assign_re)
+                    scan.consume(space_re)
+                    value = self.consume_value(scan, ',}')
+                    scan.consume(separator_re)
 
                     if value and key:
                         self.add_attr(key, value, operator == "?=>")
                     else:
                         self.fail("Failed to parse the attribute")
 
-                self.data = self.data[1:]
+                scan.advance()
+
+    def parse_modifiers(self, scan):
+        # '<' removes the whitespace inside, '>' the whitespace around the tag
+        self.strip_inner = False
+        self.strip_outer = False
+
+        while True:
+            char = scan.peek()
+
+            if char == '<' and not self.strip_inner:
+                self.strip_inner = True
+            elif char == '>' and not self.strip_outer:
+                self.strip_outer = True
+            else:
+                break
+
+            scan.advance()
 
-    def parse_modifiers(self):
-        if self.consume_regex("/"):
+        if scan.peek() == '/':
+            scan.advance()
             self.auto_close = True
         else:
             self.auto_close = self.name in auto_closing_tags
 
-    def parse_content(self):
-        if self.data.strip():
-            self.content = Display(self.data[1:], self.opts, self.line)
+    def parse_content(self, scan):
+        if scan.find_pattern(non_space_re) != -1:
+            self.content = Display(scan.rest(1), self.opts, self.line)
 
-    def execute(self, out, indent):
-        self.write_indent(indent, out)
+    def execute_open(self, out, indent, has_childs):
+        if self.strip_outer:
+            out.strip_whitespace()
+        else:
+            self.write_indent(indent, out)
 
         out.write("<%s" % self.name)
 
+        escape = self.option('escape_html')
+
         for key, values in self.attrs.items():
             out.write(' ')
             out.evaluate(key)
@@ -492,63 +818,86 @@ class XmlTag(HamlElement):
                 if index > 0:
                     out.write(" ")
 
-                out.evaluate(value)
+                out.evaluate(value, escape)
 
             out.write('"')
 
         for key, value in self.booleans.items():
-            # TODO: the key is currently evaluated twice
+            # literal conditions and keys are folded by the IR
             out.conditional_block(value)
+
+            # the value repeats the name, literal keys end up as one static
+            # text
             out.write(' ')
             out.evaluate(key)
             out.write('="')
-            out.evaluate(key)
+            out.evaluate(key, escape)
             out.write('"')
+
             out.close_block()
 
-        if self.childs:
+        if has_childs:
             out.write(">")
 
             if self.content:
                 self.fail("No content allowed for nested tags")
 
-            out.write("\n")
+            self.write_newline(out)
 
-            self.exec_childs(out, indent + 1)
+            if self.strip_inner:
+                out.strip_whitespace(True)
 
-            self.write_indent(indent, out)
+    def execute_close(self, out, indent, has_childs):
+        if has_childs:
+            if self.strip_inner:
+                out.strip_whitespace()
+            else:
+                self.write_indent(indent, out)
 
-            out.write("</%s>\n" % self.name)
+            out.write("</%s>" % self.name)
+            self.write_newline(out)
         elif self.content:
             out.write(">")
             self.content.execute(out)
-            out.write("</%s>\n" % self.name)
+            out.write("</%s>" % self.name)
+            self.write_newline(out)
         elif self.auto_close:
             out.write(" />")
         else:
             out.write("></%s>" % self.name)
 
+        if self.strip_outer:
+            out.strip_whitespace(True)
+
 
 class DirectDisplay(ChildlessElement):
     '''Directly Displaying some payload (may be evaluated)'''
 
+    __slots__ = ('display',)
+
     def parse(self, data):
         self.display = Display(data, self.opts, self.line)
 
     def execute(self, out, indent):
         self.write_indent(indent, out)
         self.display.execute(out)
+
+        # the line break separates words of the text, even when minifying
         out.write("\n")
 
 class Escape(DirectDisplay):
     '''Like DirectDisplay but escaping a special character (starts with \)'''
 
+    __slots__ = ()
+
     def parse(self, data):
         self.display = Display(data[1:], self.opts, self.line)
 
 class Doctype(ChildlessElement):
     '''Element representing a doctype declaration'''
 
+    __slots__ = ('disp',)
+
     def parse(self, data):
         parts = data.split()[1:]
 
@@ -624,13 +973,23 @@ class Doctype(ChildlessElement):
             self.fail("Doctype can't be inside a block")
 
         out.write(self.disp)
-        out.write("\n")
+        self.write_newline(out)
 
 class Display(HamlElement):
     '''Helper parsing and executing displaying. Will evaluate when starting
-    with ='''
+    with =, a leading & or ! forces escaping of the output on or off'''
+
+    __slots__ = ('evaluate', 'escape', 'data', 'parts')
 
     def parse(self, data):
+        explicit = data[:2] in ('&=', '!=', '& ', '! ')
+
+        if explicit:
+            self.escape = data[0] == '&'
+            data = data[1:]
+        else:
+            self.escape = bool(self.option('escape_html'))
+
         if data.startswith('='):
             self.evaluate = True
 
@@ -644,36 +1003,80 @@ class Display(HamlElement):
                 self.data = data[index+1:]
         else:
             self.evaluate = False
-            self.data = data
 
-    def execute(self, out, indent=None):
-        data = self.data
+            if explicit:
+                data = data[1:]
 
-        if self.evaluate:
-            out.evaluate(self.data)
-        else:
-            last = 0
+            parts = self.split_interpolations(data)
 
-            # find evaluation expressions
-            while True:
-                index = data.find('#{', last)
+            if explicit and self.escape:
+                # static text is escaped right away
+                parts = tuple(escape_html(part) if index % 2 == 0 else part
+                        for index, part in enumerate(parts))
 
-                if index == -1:
-                    break
+            self.parts = parts
 
-                end_index = data.find('}', index)
+    def split_interpolations(self, data):
+        '''Split the data into static text and #{} evaluation expressions'''
+        scan = Scanner(data)
+        parts = []
 
-                if end_index == -1:
-                    self.fail("Evaluation subexpression not closed.")
+        # find evaluation expressions
+        while True:
+            index = scan.find('#{')
+
+            if index == -1:
+                break
+
+            # everything before the expression
+            parts.append(sys.intern(scan.slice_to(index)))
+
+            scan.pos = index + 2
+            end_index = scan.find('}')
+
+            if end_index == -1:
+                self.fail("Evaluation subexpression not closed.")
+
+            # the actual evaluation
+            parts.append(scan.slice_to(end_index))
 
-                # print everything before the expression
-                out.write(data[last:index])
+            scan.pos = end_index + 1
 
-                # process the actual evaluation
-                out.evaluate(data[index+2:end_index])
+        # the end
+        parts.append(scan.rest())
+
+        return tuple(parts)
+
+    def execute(self, out, indent=None):
+        if self.evaluate:
+            out.evaluate(self.data, self.escape)
+        else:
+            for index, part in enumerate(self.parts):
+                # odd parts are the evaluation expressions
+                if index % 2:
+                    out.evaluate(part, self.escape)
+                else:
+                    out.write(part)
+
+# elements recognized by the start of a line, everything else is displayed
+line_actions = [
+        ('[#%.]\\w', XmlTag),
+        ('-', Execution),
+        ('/', Comment),
+        ('\\\\', Escape),
+        ('\\?', Declaration),
+        ('\\+\\s', Include),
+        ('!!!', Doctype),
+        ]
 
-                last = end_index + 1
+line_pattern = re.compile('|'.join('(%s)' % pattern
+    for pattern, action in line_actions))
 
-            # print the end
-            out.write(data[last:])
+def classify_line(content):
+    '''Returns the element class responsible for the (stripped) line'''
+    match = line_pattern.match(content)
 
+    if match:
+        return line_actions[match.lastindex - 1][1]
+    else:
+        return DirectDisplay
@@ -0,0 +1,169 @@
+###############################################################################
+##
+##  hardcode_haml - Haml for hardcore coders
+##  Copyright (C) 2010  Thammi
+## 
+##  This program is free software: you can redistribute it and/or modify
+##  it under the terms of the GNU Affero General Public License as published by
+##  the Free Software Foundation, either version 3 of the License, or
+##  (at your option) any later version.
+## 
+##  This program is distributed in the hope that it will be useful,
+##  but WITHOUT ANY WARRANTY; without even the implied warranty of
+##  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##  GNU Affero General Public License for more details.
+## 
+##  You should have received a copy of the GNU Affero General Public License
+##  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+###############################################################################
+
+import hashlib
+from contextlib import contextmanager
+from os.path import join
+
+from hardcode_haml.lang import c
+from hardcode_haml.output import replace_file
+
+POOL_NAME = "haml_pool"
+
+_recorders = []
+
+@contextmanager
+def collect_segments():
+    '''Context manager yielding a list which collects the static segments
+    pooled inside of it'''
+    segments = []
+    _recorders.append(segments)
+
+    try:
+        yield segments
+    finally:
+        _recorders.remove(segments)
+
+def symbol(data):
+    '''Returns the name of the define pointing to data in the pool'''
+    return "HP_" + hashlib.sha1(data.encode('utf-8')).hexdigest()[:16]
+
+def pooled(data):
+    '''Registers a static segment and returns its symbol'''
+    for segments in _recorders:
+        segments.append(data)
+
+    return symbol(data)
+
+def overlap(pool, data):
+    '''Length of the longest suffix of pool which is a prefix of data'''
+    for length in range(min(len(pool), len(data) - 1), 0, -1):
+        if pool.endswith(data[:length]):
+            return length
+
+    return 0
+
+def build_pool(segments):
+    '''Greedily packs the segments into one byte string. Segments contained
+    in the pool are shared, others are appended overlapping with the end of
+    the pool where possible. Returns the pool and a dict mapping each
+    segment to its offset'''
+    encoded = dict((data, data.encode('utf-8')) for data in set(segments))
+
+    # place long segments first, short ones are likely contained in them
+    order = sorted(encoded, key=lambda data: (-len(encoded[data]), data))
+
+    pool = bytearray()
+    offsets = {}
+
+    for data in order:
+        raw = encoded[data]
+        offset = pool.find(raw)
+
+        if offset == -1:
+            shared = overlap(pool, raw)
+            offset = len(pool) - shared
+            pool += raw[shared:]
+
+        offsets[data] = offset
+
+    return bytes(pool), offsets
+
+def inlined_size(files):
+    '''Bytes of string literals the templates would contain without a pool.
+    Identical literals are counted once per template (the compiler merges
+    those) and include the terminating NUL'''
+    return sum(len(data.encode('utf-8')) + 1
+            for segments in files for data in set(segments))
+
+def pool_literal(pool, width=72):
+    '''Format the pool as a list of C string literal lines'''
+    text = pool.decode('utf-8')
+    lines = []
+    line = []
+    length = 0
+
+    for char in text:
+        escaped = c.escape_literal(char)
+        line.append(escaped)
+        length += len(escaped)
+
+        if length >= width or char == '\n':
+            lines.append('\t"' + ''.join(line) + '"')
+            line = []
+            length = 0
+
+    if line:
+        lines.append('\t"' + ''.join(line) + '"')
+
+    return lines
+
+def write_pool(directory, files):
+    '''Writes the pool shared by all templates into the directory. files is a
+    list of the segment lists of the templates. Returns a tuple of the bytes
+    inlined without pool and the size of the pool'''
+    segments = [data for cur in files for data in cur]
+    pool, offsets = build_pool(segments)
+
+    gate = POOL_NAME.upper() + "_H"
+
+    header = [
+            "#ifndef " + gate,
+            "#define " + gate,
+            "",
+            "#ifdef __cplusplus",
+            'extern "C" {',
+            "#endif",
+            "",
+            "extern const char {name}[{size}];".format(name=POOL_NAME,
+                size=max(len(pool), 1)),
+            "",
+            "#ifdef __cplusplus",
+            "}",
+            "#endif",
+            "",
+            ]
+
+    for data in sorted(offsets, key=lambda data: (offsets[data], data)):
+        dfstr = "#define {symbol} ({name} + {offset})"
+        header.append(dfstr.format(symbol=symbol(data), name=POOL_NAME,
+            offset=offsets[data]))
+
+    header += ["", "#endif /* {gate} */".format(gate=gate), ""]
+
+    source = [
+            '#include "{name}.h"'.format(name=POOL_NAME),
+            "",
+            "const char {name}[{size}] =".format(name=POOL_NAME,
+                size=max(len(pool), 1)),
+            ]
+
+    # the array is sized without the terminating NUL of the literal
+    source += pool_literal(pool) or ['\t""']
+    source[-1] += ";"
+    source.append("")
+
+    header_path = join(directory, POOL_NAME + ".h")
+    replace_file(header_path, '\n'.join(header).encode('utf-8'))
+
+    source_path = join(directory, POOL_NAME + ".c")
+    replace_file(source_path, '\n'.join(source).encode('utf-8'))
+
+    return inlined_size(files), len(pool)
@@ -18,32 +18,262 @@
 ##
 ###############################################################################
 
+import ast
 import re
 
-from .parser import find_unescaped
+html_escapes = {
+        '&': '&amp;',
+        '<': '&lt;',
+        '>': '&gt;',
+        '"': '&quot;',
+        "'": '&#39;',
+        }
 
-def number(value):
-    if re.match("[0-9]+(?:\.[0-9]*)$", value):
-        return value
+html_escape_table = str.maketrans(html_escapes)
+
+def escape_html(text):
+    '''Replaces the characters with a special meaning in HTML by entities'''
+    return text.translate(html_escape_table)
+
+unescapes = {
+        'a': '\a',
+        'b': '\b',
+        'f': '\f',
+        'n': '\n',
+        'r': '\r',
+        't': '\t',
+        'v': '\v',
+        '\\': '\\',
+        '\'': '\'',
+        '"': '"',
+        '?': '?',
+        }
+
+escape_re = re.compile(r'\\([0-7]{1,3}|x[0-9a-fA-F]+|.)', re.S)
+
+def unescape_literal(value):
+    '''Returns the text represented by the content of a C string literal or
+    None if it contains escapes which can't be represented as text or are
+    not printed (everything after a NUL byte)'''
+    parts = []
+    last = 0
+
+    for match in escape_re.finditer(value):
+        parts.append(value[last:match.start()])
+        last = match.end()
+
+        code = match.group(1)
+
+        if code in unescapes:
+            parts.append(unescapes[code])
+            continue
+
+        if code[0] in '01234567':
+            char = int(code, 8)
+        elif code[0] == 'x':
+            char = int(code[1:], 16)
+        else:
+            return None
+
+        # bytes above ASCII are not necessarily valid text, printing the
+        # string stops at a NUL byte
+        if char == 0 or char > 0x7f:
+            return None
+
+        parts.append(chr(char))
+
+    if value.find('\\', last) != -1:
+        # trailing backslash
+        return None
+
+    parts.append(value[last:])
+
+    return ''.join(parts)
+
+c_token_re = re.compile(r'''\s*(?:
+    "((?:\\.|[^\\"])*)"         # string literal
+    |'((?:\\.|[^\\'])+)'        # character literal
+    |(-?[0-9][0-9a-zA-Z.]*)      # number
+    |(\w+)                       # identifier
+    |(\S)                        # anything else
+    )\s*''', re.S | re.X)
+
+c_int_re = re.compile(r'(-?)(0[xX][0-9a-fA-F]+|0[0-7]*|[1-9][0-9]*)([uUlL]*)$')
+c_float_re = re.compile(r'(-?(?:[0-9]+\.[0-9]*|[0-9]+(?=[eE]))(?:[eE][-+]?[0-9]+)?)'
+        r'[fFlL]?$')
+
+c_constants = {
+        'true': True,
+        'false': False,
+        }
+
+def strip_parens(value):
+    '''Removes whitespace and parentheses enclosing the whole expression'''
+    value = value.strip()
+
+    while value.startswith('(') and value.endswith(')'):
+        depth = 0
+
+        for index, char in enumerate(value):
+            if char == '(':
+                depth += 1
+            elif char == ')':
+                depth -= 1
+
+                if depth == 0 and index < len(value) - 1:
+                    # the first parenthesis is closed before the end
+                    return value
+
+        value = value[1:-1].strip()
+
+    return value
+
+def c_tokens(value):
+    '''Splits a C expression into (kind, token) tuples or returns None if
+    it contains something which can't be tokenized'''
+    tokens = []
+    pos = 0
+    kinds = ('string', 'char', 'number', 'word', 'other')
+
+    while pos < len(value):
+        match = c_token_re.match(value, pos)
+
+        if not match or match.end() == pos:
+            return None
+
+        for kind, token in zip(kinds, match.groups()):
+            if token != None:
+                tokens.append((kind, token))
+                break
+
+        pos = match.end()
+
+    return tokens
+
+def fold_c(value):
+    '''Returns the value of a constant C/C++ expression (a str, an int, a
+    float or a bool) or None if it is not known at compile time'''
+    value = strip_parens(value)
+    tokens = c_tokens(value)
+
+    if not tokens:
+        return None
+
+    kinds = set(kind for kind, token in tokens)
+
+    if kinds == set(['string']):
+        # adjacent string literals are concatenated
+        parts = [unescape_literal(token) for kind, token in tokens]
+
+        if None in parts:
+            return None
+
+        return ''.join(parts)
+
+    if len(tokens) != 1:
+        return None
+
+    kind, token = tokens[0]
+
+    if kind == 'char':
+        char = unescape_literal(token)
+
+        if char == None or len(char) != 1:
+            return None
+
+        return char
+    elif kind == 'number':
+        match = c_int_re.match(token)
+
+        if match:
+            sign, digits, suffix = match.groups()
+
+            # negative unsigned numbers wrap around depending on their size
+            if sign and 'u' in suffix.lower():
+                return None
+
+            if digits[:2] in ('0x', '0X'):
+                result = int(digits, 16)
+            elif digits.startswith('0'):
+                result = int(digits, 8)
+            else:
+                result = int(digits)
+
+            return -result if sign else result
+
+        match = c_float_re.match(token)
+
+        if match:
+            return float(match.group(1))
+        else:
+            return None
+    elif kind == 'word':
+        return c_constants.get(token)
     else:
         return None
 
-def string(value):
-    if value.startswith('"') and value.endswith('"'):
-        raw_str = value[1:-1]
-        if find_unescaped(raw_str, '"') == -1:
-            return raw_str
+def c_text(value, floats=False):
+    '''Returns the text a C/C++ constant is displayed as or None. Floats are
+    only folded if requested, like std::ostream displays them'''
+    const = fold_c(value)
+
+    if isinstance(const, bool):
+        return '1' if const else '0'
+    elif isinstance(const, int):
+        return str(const)
+    elif isinstance(const, float):
+        if not floats:
+            return None
+
+        # std::ostream shows six significant digits, keep evaluating the
+        # literal at runtime if that loses precision
+        text = '%g' % const
+
+        if float(text) == const:
+            return text
         else:
             return None
     else:
+        return const
+
+def c_condition(value):
+    '''Returns the truth value of a constant C/C++ condition or None'''
+    const = fold_c(value)
+
+    if isinstance(const, (bool, int, float)):
+        return bool(const)
+    else:
+        return None
+
+python_types = (str, int, float, bool, type(None))
+
+# the start of expressions which might be literals, literal_eval() is slow to
+# reject the rest
+python_literal_re = re.compile(
+        r'\s*(?:[-+(.0-9\'"]|[rRuU][\'"]|(?:True|False|None)\b)')
+
+def fold_python(value):
+    '''Returns a tuple with the value of a constant Python expression or
+    None if it is not known at compile time'''
+    if not python_literal_re.match(value):
         return None
 
-defaults = [number, string]
+    try:
+        const = ast.literal_eval(value.strip())
+    except (ValueError, SyntaxError, TypeError, MemoryError, RecursionError):
+        return None
 
-def find_primitive(value, primitives=defaults):
-    for primitive in primitives:
-        res = primitive(value)
+    if isinstance(const, python_types):
+        return (const,)
+    else:
+        return None
 
-        if res:
-            return res
+def python_text(value):
+    '''Returns the text a Python constant is displayed as or None'''
+    const = fold_python(value)
+    return str(const[0]) if const else None
 
+def python_condition(value):
+    '''Returns the truth value of a constant Python condition or None'''
+    const = fold_python(value)
+    return bool(const[0]) if const else None
@@ -0,0 +1,247 @@
+###############################################################################
+##
+##  hardcode_haml - Haml for hardcore coders
+##  Copyright (C) 2010  Thammi
+## 
+##  This program is free software: you can redistribute it and/or modify
+##  it under the terms of the GNU Affero General Public License as published by
+##  the Free Software Foundation, either version 3 of the License, or
+##  (at your option) any later version.
+## 
+##  This program is distributed in the hope that it will be useful,
+##  but WITHOUT ANY WARRANTY; without even the implied warranty of
+##  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##  GNU Affero General Public License for more details.
+## 
+##  You should have received a copy of the GNU Affero General Public License
+##  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+###############################################################################
+
+import sys
+import time
+
+from hardcode_haml import parser
+
+# element methods which are timed, the phase they belong to and whether
+# calls are counted
+element_methods = [
+        ('parse', 'parse', True),
+        ('execute', 'execute', True),
+        ('execute_open', 'execute', True),
+        ('execute_close', 'execute', False),
+        ]
+
+def element_classes(cls=parser.HamlElement):
+    '''Returns cls and all its subclasses'''
+    classes = [cls]
+
+    for sub in cls.__subclasses__():
+        classes.extend(element_classes(sub))
+
+    return classes
+
+class TimedWriter:
+    '''Proxy around an output module timing all method calls'''
+
+    def __init__(self, profiler, writer):
+        self._profiler = profiler
+        self._writer = writer
+
+    def __getattr__(self, name):
+        attr = getattr(self._writer, name)
+
+        if not callable(attr):
+            return attr
+
+        profiler = self._profiler
+
+        def timed(*args):
+            profiler.enter()
+
+            try:
+                return attr(*args)
+            finally:
+                profiler.leave('writer', name)
+
+        return timed
+
+class Profiler:
+    '''Records wall time and allocated memory blocks of the compiler phases
+    and of each element class. Times are exclusive, nested measurements are
+    not counted twice. Allocations are the net number of memory blocks
+    allocated by the interpreter'''
+
+    def __init__(self):
+        # (phase, name) -> [calls, seconds, blocks]
+        self.stats = {}
+        self.stack = []
+
+    def enter(self, owner=None, phase=None):
+        self.stack.append([time.perf_counter(), sys.getallocatedblocks(),
+            0.0, 0, owner, phase])
+
+    def leave(self, phase, name, count=True):
+        start, blocks, child_time, child_blocks, owner, _ = self.stack.pop()
+
+        # nested calls on the same object in the same phase are counted once
+        if owner != None and self.stack:
+            parent = self.stack[-1]
+
+            if parent[4] is owner and parent[5] == phase:
+                count = False
+
+        elapsed = time.perf_counter() - start
+        allocated = sys.getallocatedblocks() - blocks
+
+        stat = self.stats.get((phase, name))
+
+        if stat is None:
+            stat = self.stats[(phase, name)] = [0, 0.0, 0]
+
+        if count:
+            stat[0] += 1
+
+        stat[1] += elapsed - child_time
+        stat[2] += allocated - child_blocks
+
+        if self.stack:
+            parent = self.stack[-1]
+            parent[2] += elapsed
+            parent[3] += allocated
+
+    def timed(self, phase, name, fun, count=True):
+        '''Returns a wrapper of fun recording its calls'''
+        def wrapper(*args):
+            self.enter()
+
+            try:
+                return fun(*args)
+            finally:
+                self.leave(phase, name, count)
+
+        return wrapper
+
+    def timed_method(self, phase, fun, count=True):
+        '''Like timed() but naming the measurement after the class of the
+        object'''
+        def wrapper(obj, *args):
+            self.enter(obj, phase)
+
+            try:
+                return fun(obj, *args)
+            finally:
+                self.leave(phase, type(obj).__name__, count)
+
+        return wrapper
+
+    def timed_generator(self, phase, name, fun):
+        '''Wraps a generator function, only the time spent inside of the
+        generator is recorded'''
+        def wrapper(*args):
+            gen = fun(*args)
+
+            while True:
+                self.enter()
+
+                try:
+                    item = next(gen)
+                except StopIteration:
+                    self.leave(phase, name, False)
+                    return
+                except:
+                    self.leave(phase, name, False)
+                    raise
+
+                self.leave(phase, name)
+
+                yield item
+
+        return wrapper
+
+    def instrument(self):
+        '''Patch the parser to record into this profiler. Returns a function
+        restoring the original state'''
+        patches = [
+                (parser, 'split_lines', self.timed_generator('split_lines',
+                    'split_lines', parser.split_lines)),
+                (parser, 'classify_line', self.timed('classify_line',
+                    'classify_line', parser.classify_line)),
+                (parser.HamlFile, 'count_indent', self.timed_method(
+                    'count_indent', parser.HamlFile.count_indent)),
+                ]
+
+        for cls in element_classes():
+            for method, phase, count in element_methods:
+                if method in cls.__dict__:
+                    fun = self.timed_method(phase, cls.__dict__[method], count)
+                    patches.append((cls, method, fun))
+
+        originals = [(obj, name, getattr(obj, name))
+                for obj, name, _ in patches]
+
+        for obj, name, fun in patches:
+            setattr(obj, name, fun)
+
+        def restore():
+            for obj, name, fun in originals:
+                setattr(obj, name, fun)
+
+        return restore
+
+    def wrap_writer(self, writer):
+        '''Returns a proxy of the output module recording its calls'''
+        return TimedWriter(self, writer)
+
+    def report(self):
+        '''Returns the statistics as a list of dicts'''
+        return [{
+            'phase': phase,
+            'name': name,
+            'calls': calls,
+            'seconds': seconds,
+            'blocks': blocks,
+            } for (phase, name), (calls, seconds, blocks)
+            in self.stats.items()]
+
+def merge_reports(reports):
+    '''Sum up several reports'''
+    merged = {}
+
+    for report in reports:
+        for entry in report:
+            key = (entry['phase'], entry['name'])
+
+            if key in merged:
+                for field in ('calls', 'seconds', 'blocks'):
+                    merged[key][field] += entry[field]
+            else:
+                merged[key] = dict(entry)
+
+    return list(merged.values())
+
+def format_report(title, report):
+    '''Format a report as a table sorted by time'''
+    total = sum(entry['seconds'] for entry in report)
+
+    lines = ["%s: %.2f ms" % (title, total * 1000)]
+
+    phases = {}
+
+    for entry in report:
+        phases[entry['phase']] = phases.get(entry['phase'], 0) + entry['seconds']
+
+    for phase, seconds in sorted(phases.items(), key=lambda p: -p[1]):
+        share = seconds / total * 100 if total else 0
+        lines.append("  %-14s %10.2f ms %5.1f%%" % (phase, seconds * 1000, share))
+
+    lines.append("  %-14s %-18s %7s %10s %6s %9s" % ("phase", "name", "calls",
+        "ms", "%", "blocks"))
+
+    for entry in sorted(report, key=lambda e: -e['seconds']):
+        share = entry['seconds'] / total * 100 if total else 0
+        lines.append("  %-14s %-18s %7i %10.2f %5.1f%% %+9i" % (entry['phase'],
+            entry['name'], entry['calls'], entry['seconds'] * 1000, share,
+            entry['blocks']))
+
+    return "\n".join(lines)
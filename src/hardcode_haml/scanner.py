@@ -0,0 +1,112 @@
+###############################################################################
+##
+##  hardcode_haml - Haml for hardcore coders
+##  Copyright (C) 2010  Thammi
+## 
+##  This program is free software: you can redistribute it and/or modify
+##  it under the terms of the GNU Affero General Public License as published by
+##  the Free Software Foundation, either version 3 of the License, or
+##  (at your option) any later version.
+## 
+##  This program is distributed in the hope that it will be useful,
+##  but WITHOUT ANY WARRANTY; without even the implied warranty of
+##  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##  GNU Affero General Public License for more details.
+## 
+##  You should have received a copy of the GNU Affero General Public License
+##  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+###############################################################################
+
+import re
+
+_unescaped_patterns = {}
+
+def _unescaped_pattern(needle):
+    '''Returns a compiled pattern matching everything up to and including the
+    first unescaped appearance of needle'''
+    pattern = _unescaped_patterns.get(needle)
+
+    if pattern is None:
+        pattern = re.compile(r'(?:\\.|[^\\])*?' + re.escape(needle), re.S)
+        _unescaped_patterns[needle] = pattern
+
+    return pattern
+
+class Scanner:
+    '''A cursor over an immutable string. Tokens are matched in place, the
+    remainder of the string is never copied while scanning'''
+
+    def __init__(self, data, pos=0):
+        self.data = data
+        self.pos = pos
+        self.end = len(data)
+
+    def at_end(self):
+        '''Check whether the whole string was consumed'''
+        return self.pos >= self.end
+
+    def peek(self):
+        '''Returns the current character or an empty string at the end'''
+        return self.data[self.pos:self.pos+1]
+
+    def advance(self, count=1):
+        '''Move the cursor forward'''
+        self.pos = min(self.pos + count, self.end)
+
+    def consume(self, pattern):
+        '''Consume the compiled pattern at the cursor and return the match (an
+        empty string if it does not match)'''
+        match = pattern.match(self.data, self.pos)
+
+        if match:
+            self.pos = match.end()
+            return match.group()
+        else:
+            return ""
+
+    def find(self, needle):
+        '''Returns the index of the next appearance of needle or -1'''
+        return self.data.find(needle, self.pos)
+
+    def find_pattern(self, pattern):
+        '''Returns the index of the next match of the compiled pattern or -1'''
+        match = pattern.search(self.data, self.pos)
+
+        if match:
+            return match.start()
+        else:
+            return -1
+
+    def find_unescaped(self, needle):
+        '''Returns the index of the next appearance of needle which is not
+        escaped with a \\ or -1. Backslashes before the cursor count, too'''
+        data = self.data
+        start = self.pos
+        before = start
+
+        while before > 0 and data[before-1] == '\\':
+            before -= 1
+
+        # an uneven number of backslashes escapes the character at the cursor
+        if (start - before) % 2:
+            start += 1
+
+        match = _unescaped_pattern(needle).match(data, start)
+
+        if match:
+            return match.end() - len(needle)
+        else:
+            return -1
+
+    def slice(self, start):
+        '''Returns the data between start and the cursor'''
+        return self.data[start:self.pos]
+
+    def slice_to(self, end):
+        '''Returns the data between the cursor and end'''
+        return self.data[self.pos:end]
+
+    def rest(self, offset=0):
+        '''Returns the unconsumed data (skipping offset characters)'''
+        return self.data[self.pos+offset:]
@@ -0,0 +1,75 @@
+###############################################################################
+##
+##  hardcode_haml - Haml for hardcore coders
+##  Copyright (C) 2010  Thammi
+## 
+##  This program is free software: you can redistribute it and/or modify
+##  it under the terms of the GNU Affero General Public License as published by
+##  the Free Software Foundation, either version 3 of the License, or
+##  (at your option) any later version.
+## 
+##  This program is distributed in the hope that it will be useful,
+##  but WITHOUT ANY WARRANTY; without even the implied warranty of
+##  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##  GNU Affero General Public License for more details.
+## 
+##  You should have received a copy of the GNU Affero General Public License
+##  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+###############################################################################
+
+import os
+import re
+import zlib
+from os.path import join
+
+from hardcode_haml.output import replace_file
+
+UNITY_NAME = "haml_unity"
+
+unity_file_re = re.compile(re.escape(UNITY_NAME) + r'_(\d+)\.cpp$')
+
+def shard(name, shards):
+    '''Returns the unity file of a template. The assignment only depends on
+    the name, so adding a template leaves the other unity files alone'''
+    return zlib.crc32(name.encode('utf-8')) % shards
+
+def write_unity(directory, names, shards=1):
+    '''Writes unity files including the sources of the templates and one
+    header including all template headers. Unity files of a previous run
+    with more shards are removed. Returns the paths of the unity files'''
+    names = sorted(set(names))
+
+    gate = UNITY_NAME.upper() + "_H"
+
+    header = ["#ifndef " + gate, "#define " + gate, ""]
+    header += ['#include "{name}.h"'.format(name=name) for name in names]
+    header += ["", "#endif /* {gate} */".format(gate=gate), ""]
+
+    header_path = join(directory, UNITY_NAME + ".h")
+    replace_file(header_path, '\n'.join(header).encode('utf-8'))
+
+    sources = [[] for index in range(shards)]
+
+    for name in names:
+        sources[shard(name, shards)].append(name)
+
+    paths = []
+
+    for index, shard_names in enumerate(sources):
+        source = ['#include "{name}.cpp"'.format(name=name)
+                for name in shard_names]
+        source.append("")
+
+        fstr = "{name}_{index}.cpp"
+        path = join(directory, fstr.format(name=UNITY_NAME, index=index))
+        replace_file(path, '\n'.join(source).encode('utf-8'))
+        paths.append(path)
+
+    for file_name in os.listdir(directory):
+        match = unity_file_re.match(file_name)
+
+        if match and int(match.group(1)) >= shards:
+            os.remove(join(directory, file_name))
+
+    return paths
@@ -0,0 +1,111 @@
+###############################################################################
+##
+##  hardcode_haml - Haml for hardcore coders
+##  Copyright (C) 2010  Thammi
+## 
+##  This program is free software: you can redistribute it and/or modify
+##  it under the terms of the GNU Affero General Public License as published by
+##  the Free Software Foundation, either version 3 of the License, or
+##  (at your option) any later version.
+## 
+##  This program is distributed in the hope that it will be useful,
+##  but WITHOUT ANY WARRANTY; without even the implied warranty of
+##  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##  GNU Affero General Public License for more details.
+## 
+##  You should have received a copy of the GNU Affero General Public License
+##  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+###############################################################################
+
+import os
+
+import pytest
+
+from hardcode_haml.ir import STATIC_LIMIT
+from hardcode_haml.lang import c, cpp, python
+from hardcode_haml.main import compile_file
+
+writers = [
+        c.CWriter,
+        c.CCallbackWriter,
+        c.CBufferWriter,
+        c.CIovecWriter,
+        cpp.FunCppWriter,
+        cpp.ClassCppWriter,
+        python.PythonWriter,
+        ]
+
+opts = {
+        'indent': True,
+        'debug': False,
+        'auto_indent': True,
+        }
+
+page = '''\
+- #include <string>
+? const char *title, int n
+!!! 5
+%html
+  %head
+    %title = title
+    %meta{"charset" => "utf-8"}
+  %body
+    / a comment
+    #main.content(data="x" checked?=n)
+      %p Hello #{title} and #{"const"}!
+      - for(int i = 0; i < n; i++)
+        %span.item{"id" => "\\"i\\"", "class" => "foo"} item
+      %br
+      = "quoted"
+      \\= escaped
+      long text |
+        continued |
+      -# silent
+      %input(type="radio" checked?=n)
+      %p<
+        %b = title
+'''
+
+# a continuation line starting with '?' is not a declaration
+multiline = '''\
+%p some text |
+  ? more |
+%b x
+'''
+
+static_table = '%table\n' + ''.join('  %%tr\n    %%td row %i\n' % row
+        for row in range(STATIC_LIMIT // 20))
+
+def compile_source(directory, source, writer, **extra):
+    '''Compiles the source and returns the content of the written files'''
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, 'page.haml')
+
+    with open(path, 'w') as out:
+        out.write(source)
+
+    error, files = compile_file(path, writer, directory,
+            dict(opts, **extra))[:2]
+
+    assert error == None
+
+    result = {}
+
+    for name in files:
+        with open(name) as inp:
+            result[os.path.basename(name)] = inp.read()
+
+    return result
+
+@pytest.mark.parametrize('writer', writers, ids=lambda writer: writer.IDS[0])
+@pytest.mark.parametrize('source', [page, multiline, static_table],
+        ids=['page', 'multiline', 'static_table'])
+@pytest.mark.parametrize('debug', [False, True], ids=['plain', 'debug'])
+def test_stream_like_tree(tmp_path, writer, source, debug):
+    tree = compile_source(str(tmp_path / 'tree'), source, writer,
+            debug=debug)
+    stream = compile_source(str(tmp_path / 'stream'), source, writer,
+            debug=debug, stream=True)
+
+    assert stream == tree
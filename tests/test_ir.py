@@ -0,0 +1,107 @@
+###############################################################################
+##
+##  hardcode_haml - Haml for hardcore coders
+##  Copyright (C) 2010  Thammi
+## 
+##  This program is free software: you can redistribute it and/or modify
+##  it under the terms of the GNU Affero General Public License as published by
+##  the Free Software Foundation, either version 3 of the License, or
+##  (at your option) any later version.
+## 
+##  This program is distributed in the hope that it will be useful,
+##  but WITHOUT ANY WARRANTY; without even the implied warranty of
+##  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##  GNU Affero General Public License for more details.
+## 
+##  You should have received a copy of the GNU Affero General Public License
+##  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+###############################################################################
+
+from hardcode_haml import primitives
+from hardcode_haml.ir import STATIC_LIMIT, IRBuilder
+
+class Recorder:
+    '''Output module recording the calls it gets'''
+
+    def __init__(self):
+        self.calls = []
+        self.folded = 0
+
+    def fold_text(self, cmd):
+        self.folded += 1
+        return primitives.c_text(cmd)
+
+    def fold_condition(self, expression):
+        return primitives.c_condition(expression)
+
+    def __getattr__(self, name):
+        def record(*args):
+            self.calls.append((name,) + args)
+
+        return record
+
+def build(*calls):
+    '''Passes the calls through an IRBuilder and returns the recorder'''
+    out = Recorder()
+    ir = IRBuilder(out)
+
+    for call in calls:
+        getattr(ir, call[0])(*call[1:])
+
+    ir.finish()
+
+    return out
+
+def test_merge_static():
+    out = build(('write', 'a'), ('evaluate', '"b"'), ('write', 'c'))
+    assert out.calls == [('write', 'abc'), ('finish',)]
+
+def test_fold_once():
+    out = build(('evaluate', '"<"', True), ('evaluate', 'x'))
+    assert out.calls == [('write', '&lt;'), ('evaluate', 'x', False),
+            ('finish',)]
+    assert out.folded == 2
+
+def test_comments_before_static():
+    out = build(('write', 'a'), ('comment', 'c'), ('write', 'b'))
+    assert out.calls == [('comment', 'c'), ('write', 'ab'), ('finish',)]
+
+def test_empty_conditional():
+    out = build(('write', 'a'), ('conditional_block', 'x'),
+            ('comment', 'c'), ('close_block',), ('write', 'b'))
+    assert out.calls == [('comment', 'c'), ('write', 'ab'), ('finish',)]
+
+def test_literal_conditions():
+    out = build(('conditional_block', '0'), ('write', 'dead'),
+            ('execute', 'f()'), ('close_block',),
+            ('conditional_block', '1'), ('write', 'alive'), ('close_block',))
+    assert out.calls == [('write', 'alive'), ('finish',)]
+
+def test_dynamic_conditional():
+    out = build(('write', 'a'), ('conditional_block', 'x'), ('write', 'b'),
+            ('write', 'c'), ('close_block',))
+    assert out.calls == [('write', 'a'), ('conditional_block', 'x'),
+            ('write', 'bc'), ('close_block',), ('finish',)]
+
+def test_blocks_passed_on():
+    out = Recorder()
+    ir = IRBuilder(out)
+
+    ir.write('a')
+    ir.block_exec('for(;;)')
+    ir.write('b')
+
+    # streaming needs the block before it is closed
+    assert out.calls == [('write', 'a'), ('block_exec', 'for(;;)')]
+
+def test_static_limit():
+    piece = 'x' * 1000
+    out = build(*[('write', piece)] * (3 * STATIC_LIMIT // len(piece)))
+
+    writes = [call[1] for call in out.calls if call[0] == 'write']
+
+    assert ''.join(writes) == piece * (3 * STATIC_LIMIT // len(piece))
+    assert len(writes) > 1
+    assert all(len(data) <= STATIC_LIMIT + len(piece) for data in writes)
+    assert ('flush',) in out.calls
@@ -0,0 +1,104 @@
+###############################################################################
+##
+##  hardcode_haml - Haml for hardcore coders
+##  Copyright (C) 2010  Thammi
+## 
+##  This program is free software: you can redistribute it and/or modify
+##  it under the terms of the GNU Affero General Public License as published by
+##  the Free Software Foundation, either version 3 of the License, or
+##  (at your option) any later version.
+## 
+##  This program is distributed in the hope that it will be useful,
+##  but WITHOUT ANY WARRANTY; without even the implied warranty of
+##  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##  GNU Affero General Public License for more details.
+## 
+##  You should have received a copy of the GNU Affero General Public License
+##  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+###############################################################################
+
+import pytest
+
+from hardcode_haml.primitives import c_condition, c_text, python_condition, \
+        python_text
+
+@pytest.mark.parametrize('value, text', [
+        ('42', '42'),
+        ('-7l', '-7'),
+        ('0x1f', '31'),
+        ('010', '8'),
+        ('1u', '1'),
+        ('true', '1'),
+        ('"a" "b"', 'ab'),
+        ('("x\\ty")', 'x\ty'),
+        ("'c'", 'c'),
+        ])
+def test_c_text(value, text):
+    assert c_text(value) == text
+    assert c_text(value, floats=True) == text
+
+@pytest.mark.parametrize('value', [
+        'x',
+        'f(1)',
+        '1 + 2',
+        # printing stops at the NUL byte
+        '"a\\0b"',
+        '"a\\x00"',
+        '"a" "\\0"',
+        "'\\0'",
+        # wraps around depending on the size of the type
+        '-1u',
+        '-1UL',
+        # not necessarily valid text
+        '"\\xff"',
+        ])
+def test_c_text_dynamic(value):
+    assert c_text(value) == None
+    assert c_text(value, floats=True) == None
+
+@pytest.mark.parametrize('value, text', [
+        ('3.0', '3'),
+        ('0.5f', '0.5'),
+        ('1e10', '1e+10'),
+        ('-0.0', '-0'),
+        # std::ostream shows six significant digits
+        ('0.1234567', None),
+        ('1234567.0', None),
+        ])
+def test_c_text_floats(value, text):
+    # C prints floats differently, only C++ folds them
+    assert c_text(value) == None
+    assert c_text(value, floats=True) == text
+
+@pytest.mark.parametrize('value, condition', [
+        ('1', True),
+        ('0', False),
+        ('(false)', False),
+        ('0.0', False),
+        ('"x"', None),
+        ('x', None),
+        ])
+def test_c_condition(value, condition):
+    assert c_condition(value) == condition
+
+@pytest.mark.parametrize('value, text', [
+        ('"a" "b"', 'ab'),
+        ('1.5', '1.5'),
+        ('-3', '-3'),
+        ('None', 'None'),
+        ('x', None),
+        ('f(1)', None),
+        ('[1, 2]', None),
+        ])
+def test_python_text(value, text):
+    assert python_text(value) == text
+
+@pytest.mark.parametrize('value, condition', [
+        ('True', True),
+        ('0', False),
+        ('""', False),
+        ('x', None),
+        ])
+def test_python_condition(value, condition):
+    assert python_condition(value) == condition